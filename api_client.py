@@ -0,0 +1,38 @@
+import os
+
+from response_cache import DEFAULT_CACHE_PATH, CachedClient, ResponseCache
+from retry import RetryingClient
+
+
+def create_client(
+    base_url=None, cache_mode=None, cache_path=None, retry_policy=None, rate_limiter=None
+):
+    """
+    OpenAI client shared by intent.py, label.py and the OpenAI embeddings.
+
+    Requests go through the response cache in `cache_mode` ("passthrough",
+    "record" or "replay"), defaulting to the OPENAI_CACHE_MODE and
+    OPENAI_CACHE_PATH environment variables. Replay mode needs neither
+    network access nor an API key.
+
+    Transient errors of actual API calls are retried with `retry_policy`
+    instead of the client's built-in retries. Each attempt, but no cache
+    hit, waits for `rate_limiter` if it is given.
+    """
+    if cache_mode is None:
+        cache_mode = os.environ.get("OPENAI_CACHE_MODE", "passthrough")
+
+    client = None
+    if cache_mode != "replay":
+        from openai import OpenAI
+
+        client = RetryingClient(
+            OpenAI(base_url=base_url, max_retries=0), retry_policy, rate_limiter
+        )
+
+    if cache_mode == "passthrough":
+        return client
+
+    return CachedClient(
+        client, ResponseCache(cache_path or DEFAULT_CACHE_PATH), cache_mode
+    )
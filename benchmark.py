@@ -0,0 +1,406 @@
+"""
+Offline benchmarks of the evaluators, the batched scoring paths, the
+embedding caches and label data loading.
+
+    python benchmark.py [--items 2000] [--output bench.json] [--compare baseline.json]
+
+Sentences are synthetic Korean-like text and embeddings come from a fake,
+deterministic backend, so results only depend on this code and the machine.
+Each benchmark reports throughput, p50/p99 latency per operation and the
+peak RSS of the process so far. Results are written as JSON so they can be
+compared across commits with `--compare`.
+"""
+import contextlib
+import hashlib
+import io
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+import numpy as np
+
+from evaluate import (
+    EmbeddingEvaluator,
+    LabeledData,
+    evaluate,
+    evaluate_dataset,
+    load_label_data,
+    score_dataset,
+)
+from sentence_similarity_bert import BertEmbedding
+from sentence_similarity_openai import OpenAIEmbedding
+
+
+SYLLABLES = (
+    "가나다라마바사아자차카타파하"
+    "고노도로모보소오조초코토포호"
+    "구누두루무부수우주추쿠투푸후"
+    "기니디리미비시이지치키티피히"
+)
+
+ENDINGS = [
+    "하고 싶어요",
+    "알려주세요",
+    "궁금해요",
+    "있나요",
+    "할 수 있을까요",
+    "변경해 주세요",
+]
+
+
+def synthetic_sentence(rng):
+    words = [
+        "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(1, 4)))
+        for _ in range(rng.randint(2, 6))
+    ]
+    return " ".join(words) + " " + rng.choice(ENDINGS)
+
+
+def synthetic_sentences(count, seed=0):
+    rng = random.Random(seed)
+    return [synthetic_sentence(rng) for _ in range(count)]
+
+
+def synthetic_label_items(count, num_choices=5, seed=0):
+    """
+    Items in the format written by label.py. Choices are drawn from a shared
+    pool, so datasets repeat strings as real chatbots do.
+    """
+    rng = random.Random(seed)
+    pool = synthetic_sentences(max(num_choices, count // 2), seed + 1)
+
+    items = []
+    for _ in range(count):
+        choices = [
+            {"text": text, "nextSectionId": str(i)}
+            for i, text in enumerate(rng.sample(pool, num_choices))
+        ]
+        items.append(
+            {
+                "intent": synthetic_sentence(rng),
+                "prompt": "",
+                "choices": choices,
+                "choice": rng.choice(choices),
+            }
+        )
+    return items
+
+
+class FakeEncoder:
+    """
+    Deterministic stand-in for an embedding model: each sentence maps to a
+    pseudo-random vector with positive entries seeded by its hash.
+    `delay` seconds are spent per call, to mimic model or network cost.
+    """
+
+    def __init__(self, dim=384, delay=0.0):
+        self.dim = dim
+        self.delay = delay
+        self.calls = 0
+
+    def _vector(self, sentence):
+        seed = int.from_bytes(hashlib.sha256(sentence.encode()).digest()[:8], "little")
+        return np.random.default_rng(seed).random(self.dim, dtype=np.float32)
+
+    def encode(self, sentences):
+        self.calls += 1
+        if self.delay:
+            time.sleep(self.delay)
+        return np.array([self._vector(sentence) for sentence in sentences])
+
+
+class FakeEmbeddingsClient:
+    """
+    Stand-in for the OpenAI client's `embeddings.create`.
+    """
+
+    def __init__(self, encoder):
+        self._encoder = encoder
+        self.embeddings = self
+
+    def create(self, input, model):
+        vectors = self._encoder.encode(list(input))
+        return SimpleNamespace(
+            data=[SimpleNamespace(embedding=vector.tolist()) for vector in vectors]
+        )
+
+
+class FakeEvaluator(EmbeddingEvaluator):
+    def __init__(self, dim=384, delay=0.0):
+        super().__init__(f"fake-{dim}", store_path=None)
+        self._dim = dim
+        self._delay = delay
+
+    def name(self):
+        return "FakeEvaluator"
+
+    def load_model(self):
+        return FakeEncoder(self._dim, self._delay)
+
+    def encode(self, sentences):
+        return self._model.encode(sentences)
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    if sys.platform == "darwin":
+        peak /= 1024
+    return peak / 1024
+
+
+def measure(name, operations, unit, run, repeat=1):
+    """
+    Time `run(i)` for i in range(operations), `repeat` times, and summarize
+    per-operation latency and throughput.
+    """
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for i in range(operations):
+            begin = time.perf_counter()
+            run(i)
+            latencies.append(time.perf_counter() - begin)
+    elapsed = time.perf_counter() - start
+
+    latencies = np.array(latencies) * 1000
+    return {
+        "name": name,
+        "operations": operations * repeat,
+        "unit": unit,
+        "throughput": operations * repeat / elapsed,
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def bench_similarity(items, dim):
+    evaluator = FakeEvaluator(dim)
+    pairs = [(item.intent, choice) for item in items for choice in item.choices]
+    return measure(
+        "evaluator.similarity",
+        len(pairs),
+        "pairs/s",
+        lambda i: evaluator.similarity(*pairs[i]),
+    )
+
+
+def bench_evaluate(items, dim):
+    evaluator = FakeEvaluator(dim)
+    # Silence its per-item output
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = measure(
+            "evaluate (per item)", 1, "runs/s", lambda i: evaluate(evaluator, items)
+        )
+    result["items_per_s"] = result["throughput"] * len(items)
+    return result
+
+
+def bench_score_dataset(items, dim, repeat):
+    evaluator = FakeEvaluator(dim)
+    result = measure(
+        "score_dataset", 1, "runs/s", lambda i: score_dataset(evaluator, items), repeat
+    )
+    result["items_per_s"] = result["throughput"] * len(items)
+    return result
+
+
+def bench_evaluate_dataset(items, dim, repeat):
+    evaluator = FakeEvaluator(dim)
+    result = measure(
+        "evaluate_dataset",
+        1,
+        "runs/s",
+        lambda i: evaluate_dataset(evaluator, items),
+        repeat,
+    )
+    result["items_per_s"] = result["throughput"] * len(items)
+    return result
+
+
+def bench_embedding_cache(name, embedding, sentences):
+    """
+    Miss path on first sight of each sentence, hit path on the second.
+    """
+    miss = measure(
+        f"{name} cache miss",
+        len(sentences),
+        "sentences/s",
+        lambda i: embedding.embeddings([sentences[i]]),
+    )
+    hit = measure(
+        f"{name} cache hit",
+        len(sentences),
+        "sentences/s",
+        lambda i: embedding.embeddings([sentences[i]]),
+    )
+    return [miss, hit]
+
+
+def bench_load_label_data(items, directory):
+    results = []
+    for extension in ("json", "log"):
+        filename = os.path.join(directory, f"labels.{extension}")
+        with open(filename, "w") as f:
+            if extension == "json":
+                json.dump(items, f, ensure_ascii=False)
+            else:
+                for item in items:
+                    f.write(json.dumps(item, ensure_ascii=False) + "\n")
+
+        result = measure(
+            f"load_label_data ({extension})",
+            1,
+            "runs/s",
+            lambda i: load_label_data(filename),
+            3,
+        )
+        result["items_per_s"] = result["throughput"] * len(items)
+        results.append(result)
+    return results
+
+
+BENCHMARKS = (
+    "similarity",
+    "evaluate",
+    "score_dataset",
+    "evaluate_dataset",
+    "bert_cache",
+    "openai_cache",
+    "load_label_data",
+)
+
+
+def run_benchmarks(num_items=2000, num_choices=5, dim=384, repeat=5, seed=0, only=None):
+    raw_items = synthetic_label_items(num_items, num_choices, seed)
+    items = [LabeledData(item) for item in raw_items]
+    sentences = synthetic_sentences(num_items, seed + 2)
+    selected = set(only or BENCHMARKS)
+
+    results = []
+    if "similarity" in selected:
+        results.append(bench_similarity(items[: max(1, num_items // 10)], dim))
+    if "evaluate" in selected:
+        results.append(bench_evaluate(items, dim))
+    if "score_dataset" in selected:
+        results.append(bench_score_dataset(items, dim, repeat))
+    if "evaluate_dataset" in selected:
+        results.append(bench_evaluate_dataset(items, dim, repeat))
+    if "bert_cache" in selected:
+        embedding = BertEmbedding("fake", store_path=None, model=FakeEncoder(dim))
+        results += bench_embedding_cache("BertEmbedding", embedding, sentences)
+    if "openai_cache" in selected:
+        embedding = OpenAIEmbedding(
+            "fake", store_path=None, client=FakeEmbeddingsClient(FakeEncoder(dim))
+        )
+        results += bench_embedding_cache("OpenAIEmbedding", embedding, sentences)
+    if "load_label_data" in selected:
+        with tempfile.TemporaryDirectory() as directory:
+            results += bench_load_label_data(raw_items, directory)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            # The commit of this checkout, wherever the benchmark is run from
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(baseline, results, threshold=0.1):
+    """
+    Lines comparing throughput with a baseline run, flagging slowdowns
+    larger than `threshold`.
+    """
+    previous = {result["name"]: result for result in baseline["results"]}
+    lines = []
+    for result in results:
+        before = previous.get(result["name"])
+        if before is None:
+            continue
+        ratio = result["throughput"] / before["throughput"]
+        flag = "  REGRESSION" if ratio < 1 - threshold else ""
+        lines.append(f"{result['name']}: {ratio:.2f}x of {baseline['commit']}{flag}")
+    return lines
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark evaluation hot paths")
+    parser.add_argument("--items", type=int, default=2000)
+    parser.add_argument("--choices", type=int, default=5)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--only", default=None, help=f"comma-separated among {', '.join(BENCHMARKS)}"
+    )
+    parser.add_argument("--output", default=None, help="JSON file to write results to")
+    parser.add_argument("--compare", default=None, help="JSON results of a baseline run")
+    parser.add_argument("--threshold", type=float, default=0.1)
+    args = parser.parse_args()
+
+    only = None
+    if args.only:
+        only = [name.strip() for name in args.only.split(",")]
+        for name in only:
+            if name not in BENCHMARKS:
+                parser.error(f"Unknown benchmark {name}")
+
+    # Silence progress output of the benchmarked code
+    with contextlib.redirect_stderr(io.StringIO()):
+        results = run_benchmarks(
+            args.items, args.choices, args.dim, args.repeat, args.seed, only
+        )
+
+    for result in results:
+        line = (
+            f"{result['name']}: {result['throughput']:.1f} {result['unit']}, "
+            f"p50 {result['p50_ms']:.3f} ms, p99 {result['p99_ms']:.3f} ms, "
+            f"peak RSS {result['peak_rss_mb']:.1f} MB"
+        )
+        if result.get("items_per_s"):
+            line += f", {result['items_per_s']:.1f} items/s"
+        print(line)
+
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {
+            "items": args.items,
+            "choices": args.choices,
+            "dim": args.dim,
+            "repeat": args.repeat,
+            "seed": args.seed,
+        },
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+        if baseline["config"] != report["config"]:
+            print("Warning: baseline was run with a different configuration")
+        for line in compare_results(baseline, results, args.threshold):
+            print(line)
@@ -0,0 +1,284 @@
+import json
+import os
+
+import numpy as np
+
+from embedding_cache import LRUEmbeddingCache
+from embedding_codec import EmbeddingCodec
+from embedding_store import EmbeddingStore, normalize_text
+from instrumentation import Progress
+
+
+# Version 2 added codecs, with `scales.npy` and `components.npy`
+ARTIFACT_VERSION = 2
+
+
+class EmbeddingArtifact:
+    """
+    Read-only embeddings of known texts, written once by precompute.py.
+
+    A directory holding `vectors.npy` (matrix of codes), `index.json`
+    (normalized text of each row) and `meta.json` (version, model name,
+    dimension and codec). int8 codecs add `scales.npy` and PCA codecs add
+    `components.npy`. Codes are opened zero-copy with mmap and decoded on
+    lookup; texts embedded on the fly go through the same codec, so they are
+    comparable with stored ones.
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            meta = json.load(f)
+        if meta["version"] != ARTIFACT_VERSION:
+            raise ValueError(
+                f"Artifact version should be {ARTIFACT_VERSION}, but {meta['version']} is given."
+            )
+
+        self.path = path
+        self.model_name = meta["model"]
+        self.dim = meta["dim"]
+        self.codec = EmbeddingCodec.parse(meta["codec"])
+
+        self._vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+        self._scales = None
+        if self.codec.dtype == "int8":
+            self._scales = np.load(os.path.join(path, "scales.npy"))
+        if self.codec.reduction == "pca":
+            self.codec.components = np.load(os.path.join(path, "components.npy"))
+        with open(os.path.join(path, "index.json"), "r") as f:
+            self._rows = {text: i for i, text in enumerate(json.load(f))}
+
+    def __getstate__(self):
+        # Reopened by path, instead of copying the vectors into the pickle
+        return self.path
+
+    def __setstate__(self, path):
+        self.__init__(path)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, text):
+        return normalize_text(text) in self._rows
+
+    def get(self, text):
+        """
+        Return embedding of given text as float32, or None if it is unknown.
+        """
+        row = self._rows.get(normalize_text(text))
+        if row is None:
+            return None
+        return self._decode([row])[0]
+
+    def _decode(self, rows):
+        scales = None if self._scales is None else self._scales[rows]
+        return self.codec.decode(self._vectors[rows], scales)
+
+    def embed(self, texts, encode):
+        """
+        Return embeddings of given texts as a float32 2D array.
+        Unknown texts are embedded with `encode` in one call.
+        """
+        rows = [self._rows.get(normalize_text(text)) for text in texts]
+        missing = [text for text, row in zip(texts, rows) if row is None]
+
+        embeddings = np.empty((len(texts), self.dim), dtype=np.float32)
+        known = [i for i, row in enumerate(rows) if row is not None]
+        if known:
+            embeddings[known] = self._decode([rows[i] for i in known])
+        if missing:
+            embeddings[
+                [i for i, row in enumerate(rows) if row is None]
+            ] = self.codec.round_trip(encode(missing))
+        return embeddings
+
+
+class EmbeddingLayers:
+    """
+    Lookup chain shared by the evaluators and embedders: a precomputed
+    artifact, then the persistent store, then the model.
+
+    Subclasses set `model_name`, `_artifact` (initially None) and `_store`
+    (None without a store), and implement `_encode`.
+    """
+
+    def _encode(self, sentences):
+        raise NotImplementedError()
+
+    def use_artifact(self, path):
+        """
+        Read embeddings precomputed by precompute.py before the store and model.
+        """
+        artifact = EmbeddingArtifact(path)
+        if artifact.model_name != self.model_name:
+            raise ValueError(
+                f"Artifact model should be {self.model_name}, but {artifact.model_name} is given."
+            )
+        self._artifact = artifact
+
+    def _encode_stored(self, sentences):
+        if self._store is None:
+            return np.asarray(self._encode(sentences))
+        return self._store.embed(sentences, self._encode)
+
+    def _encode_missing(self, sentences):
+        """
+        Return embeddings of given sentences as a 2D array, encoding only
+        those found in neither the artifact nor the store.
+        """
+        if self._artifact is None:
+            return self._encode_stored(sentences)
+        return self._artifact.embed(sentences, self._encode_stored)
+
+
+class Embedder(EmbeddingLayers):
+    """
+    Embeddings of a model behind the lookup chain and an in-memory cache,
+    shared by `BertEmbedding` and `OpenAIEmbedding`.
+    """
+
+    def __init__(
+        self, model_name, store_path, cache_max_entries, cache_max_bytes, cache_codec
+    ):
+        self.model_name = model_name
+        self._embedding_cache = LRUEmbeddingCache(
+            cache_max_entries, cache_max_bytes, cache_codec
+        )
+        self._artifact = None
+        self._store = None
+        if store_path is not None:
+            self._store = EmbeddingStore(model_name, store_path)
+
+    def embeddings(self, sentences):
+        """
+        Return embeddings of given sentences, encoding uncached ones in one batch.
+        """
+        return self._embedding_cache.embed(sentences, self._encode_missing)
+
+    def cached_embeddings(self, sentences):
+        """
+        Return embeddings of given sentences kept in memory, or None for
+        those that are not, without touching the store or the model.
+        """
+        return [self._embedding_cache.peek(sentence) for sentence in sentences]
+
+    def cache_stats(self):
+        """
+        Return hit/miss/eviction counters of the in-memory cache.
+        """
+        return self._embedding_cache.stats()
+
+    def embedding(self, sentence):
+        """
+        Return embedding of given sentence.
+        """
+        return self.embeddings([sentence])[0]
+
+    def sentence_similarity(self, s1, s2):
+        """
+        Evaluates similarity of two setences.
+        """
+        s1_embedding = self.embedding(s1)
+        s2_embedding = self.embedding(s2)
+
+        return np.dot(s1_embedding, s2_embedding) / (
+            np.linalg.norm(s1_embedding) * np.linalg.norm(s2_embedding)
+        )
+
+
+def _fit_sample(codec, texts, encode, batch_size, sample_size, seed=0):
+    """
+    Fit the codec on a random sample of the whole corpus.
+    Returns the sampled embeddings by text position, so they are not
+    encoded twice.
+    """
+    rng = np.random.default_rng(seed)
+    positions = np.sort(
+        rng.choice(len(texts), min(len(texts), sample_size), replace=False)
+    ).tolist()
+
+    vectors = []
+    for start in range(0, len(positions), batch_size):
+        batch = positions[start : start + batch_size]
+        vectors.extend(np.asarray(encode([texts[i] for i in batch])))
+    codec.fit(vectors)
+    return dict(zip(positions, vectors))
+
+
+def write_artifact(
+    path, model_name, texts, encode, codec=None, batch_size=512, fit_size=10000
+):
+    """
+    Embed unique texts with `encode` in batches of `batch_size` and write
+    them as an artifact at `path`, stored with `codec` (float32 if None).
+    An unfitted PCA codec is fitted on a random sample of `fit_size` texts.
+    Returns the number of rows.
+    """
+    if codec is None:
+        codec = EmbeddingCodec()
+
+    keys = {}
+    for text in texts:
+        key = normalize_text(text)
+        if key and key not in keys:
+            keys[key] = text
+    if not keys:
+        raise ValueError("No texts to embed")
+
+    os.makedirs(path, exist_ok=True)
+    meta_path = os.path.join(path, "meta.json")
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    originals = list(keys.values())
+
+    sampled = {}
+    if codec.needs_fit:
+        sampled = _fit_sample(codec, originals, encode, batch_size, fit_size)
+
+    vectors = None
+    scales = np.ones(len(originals), dtype=np.float32)
+    progress = Progress(len(originals), f"Embedding texts of {model_name}")
+    for start in range(0, len(originals), batch_size):
+        positions = range(start, min(start + batch_size, len(originals)))
+        missing = [i for i in positions if i not in sampled]
+        encoded = {}
+        if missing:
+            encoded = dict(zip(missing, encode([originals[i] for i in missing])))
+        batch = np.asarray(
+            [sampled.pop(i) if i in sampled else encoded[i] for i in positions]
+        )
+
+        codes, batch_scales = codec.encode(batch)
+        if vectors is None:
+            vectors = np.lib.format.open_memmap(
+                os.path.join(path, "vectors.npy"),
+                mode="w+",
+                dtype=codec.dtype,
+                shape=(len(originals), codes.shape[1]),
+            )
+        vectors[start : start + len(codes)] = codes
+        if batch_scales is not None:
+            scales[start : start + len(codes)] = batch_scales
+        progress.update(len(batch))
+    vectors.flush()
+
+    if codec.dtype == "int8":
+        np.save(os.path.join(path, "scales.npy"), scales)
+    if codec.reduction == "pca":
+        np.save(os.path.join(path, "components.npy"), codec.components)
+    with open(os.path.join(path, "index.json"), "w") as f:
+        json.dump(list(keys), f, ensure_ascii=False)
+
+    # Written last, so an interrupted run never leaves a readable artifact
+    with open(meta_path, "w") as f:
+        json.dump(
+            {
+                "version": ARTIFACT_VERSION,
+                "model": model_name,
+                "dim": vectors.shape[1],
+                "dtype": codec.dtype,
+                "codec": codec.spec,
+            },
+            f,
+        )
+
+    return len(originals)
@@ -0,0 +1,140 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+
+
+class LRUEmbeddingCache:
+    """
+    In-memory embedding cache bounded by number of entries and/or bytes.
+    Rows are kept as float32 arrays, or encoded with `codec` to fit more of
+    them in the budget, and the least recently used ones are evicted once
+    the budget is exceeded.
+    """
+
+    def __init__(self, max_entries=None, max_bytes=DEFAULT_CACHE_BYTES, codec=None):
+        if codec is not None and codec.needs_fit:
+            # A cache only ever sees a few vectors at a time to fit on
+            raise ValueError(
+                f"Codec {codec} should be fitted on sample embeddings before caching"
+            )
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.codec = codec
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        """
+        Return cached embedding of given key, or None if it is not cached.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return self._decode(entry)
+
+    def peek(self, key):
+        """
+        Like `get`, but a miss is not counted, for callers that fall back to
+        `embed` which counts it.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return self._decode(entry)
+
+    def _encode(self, vector):
+        if self.codec is None:
+            # A copy, since a row of a batch would keep the whole batch alive
+            return np.array(vector, dtype=np.float32), None
+        return self.codec.encode(vector)
+
+    def _decode(self, entry):
+        if self.codec is None:
+            return entry[0]
+        return self.codec.decode(*entry)
+
+    @staticmethod
+    def _nbytes(entry):
+        codes, scale = entry
+        return codes.nbytes + (0 if scale is None else scale.nbytes)
+
+    def put(self, key, vector):
+        self._put(key, self._encode(vector))
+
+    def _put(self, key, entry):
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.nbytes -= self._nbytes(previous)
+            self._entries[key] = entry
+            self.nbytes += self._nbytes(entry)
+            self._evict()
+
+    def _evict(self):
+        while self._entries and (
+            (self.max_entries is not None and len(self._entries) > self.max_entries)
+            or (self.max_bytes is not None and self.nbytes > self.max_bytes)
+        ):
+            _, entry = self._entries.popitem(last=False)
+            self.nbytes -= self._nbytes(entry)
+            self.evictions += 1
+
+    def embed(self, texts, encode):
+        """
+        Return embeddings of given texts.
+        Texts missing from the cache are embedded with `encode` in one call.
+        """
+        vectors = {}
+        for text in texts:
+            if text not in vectors:
+                vectors[text] = self.get(text)
+
+        missing = [text for text, vector in vectors.items() if vector is None]
+        if missing:
+            for text, vector in zip(missing, encode(missing)):
+                # Return what a later hit would, even with a lossy codec
+                entry = self._encode(vector)
+                vectors[text] = self._decode(entry)
+                self._put(text, entry)
+
+        return [vectors[text] for text in texts]
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self.nbytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,121 @@
+import numpy as np
+
+
+DTYPES = ("float32", "float16", "int8")
+
+REDUCTIONS = ("truncate", "pca")
+
+
+class EmbeddingCodec:
+    """
+    Compact storage of embeddings: float16 or int8 scalar quantization,
+    optionally after reducing them to their first `dim` dimensions
+    (Matryoshka-style truncation) or to their top `dim` principal components.
+
+    int8 rows are scaled by their largest absolute value, which is kept as
+    one float32 per row. Decoded vectors stay in the reduced space, so every
+    vector compared with them must go through the same codec.
+    Codecs are written as specs like "float16", "int8" or "int8+pca:256".
+    """
+
+    def __init__(self, dtype="float32", reduction=None, dim=None):
+        if dtype not in DTYPES:
+            raise ValueError(f"Dtype should be one of {DTYPES}, but {dtype} is given.")
+        if reduction is not None and reduction not in REDUCTIONS:
+            raise ValueError(
+                f"Reduction should be one of {REDUCTIONS}, but {reduction} is given."
+            )
+        if (reduction is None) != (dim is None):
+            raise ValueError("Reduction and dim should be given together")
+
+        self.dtype = dtype
+        self.reduction = reduction
+        self.dim = dim
+        self.components = None
+
+    @classmethod
+    def parse(cls, spec):
+        dtype, _, reduction = spec.partition("+")
+        if not reduction:
+            return cls(dtype)
+        reduction, _, dim = reduction.partition(":")
+        return cls(dtype, reduction, int(dim))
+
+    @property
+    def spec(self):
+        if self.reduction is None:
+            return self.dtype
+        return f"{self.dtype}+{self.reduction}:{self.dim}"
+
+    def __str__(self):
+        return self.spec
+
+    @property
+    def needs_fit(self):
+        return self.reduction == "pca" and self.components is None
+
+    def fit(self, vectors):
+        """
+        Learn principal components of sample vectors, for "pca" only.
+        Components are not centered, so dot products are preserved best.
+        """
+        if self.reduction == "pca":
+            vectors = np.asarray(vectors, dtype=np.float32)
+            _, _, components = np.linalg.svd(vectors, full_matrices=False)
+            if len(components) < self.dim:
+                raise ValueError(
+                    f"PCA to {self.dim} dimensions needs at least {self.dim} samples, "
+                    f"but {len(components)} are given."
+                )
+            self.components = components[: self.dim]
+        return self
+
+    def reduce(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.reduction == "truncate":
+            return vectors[..., : self.dim]
+        if self.reduction == "pca":
+            if self.components is None:
+                raise ValueError("PCA codec should be fitted before use")
+            return vectors @ self.components.T
+        return vectors
+
+    def encode(self, vectors):
+        """
+        Return codes of given vectors, and the scale of each row for int8
+        (None otherwise).
+        """
+        vectors = self.reduce(vectors)
+        if self.dtype != "int8":
+            return vectors.astype(self.dtype), None
+
+        scales = np.max(np.abs(vectors), axis=-1) / 127
+        scales = np.where(scales > 0, scales, 1).astype(np.float32)
+        codes = np.rint(vectors / scales[..., None]).astype(np.int8)
+        return codes, scales
+
+    def decode(self, codes, scales=None):
+        """
+        Return float32 vectors of given codes.
+        """
+        vectors = np.asarray(codes, dtype=np.float32)
+        if scales is not None:
+            vectors = vectors * np.asarray(scales, dtype=np.float32)[..., None]
+        return vectors
+
+    def round_trip(self, vectors):
+        """
+        Return vectors as they are read back after storage.
+        """
+        return self.decode(*self.encode(vectors))
+
+    def bytes_per_vector(self, dim):
+        """
+        Stored size of one vector of `dim` dimensions.
+        """
+        if self.reduction is not None:
+            dim = min(dim, self.dim)
+        size = dim * np.dtype(self.dtype).itemsize
+        if self.dtype == "int8":
+            size += np.dtype(np.float32).itemsize
+        return size
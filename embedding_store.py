@@ -0,0 +1,239 @@
+import contextlib
+import json
+import os
+import re
+import threading
+import unicodedata
+
+import numpy as np
+
+from instrumentation import count, timer
+
+try:
+    import fcntl
+except ImportError:  # Windows, where stores should not be shared between processes
+    fcntl = None
+
+
+DEFAULT_STORE_PATH = os.environ.get("EMBEDDING_STORE", ".embedding_store")
+
+
+def normalize_text(text):
+    """
+    Normalize text used as a key of the store.
+    """
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def _directory_name(model_name):
+    return re.sub(r"[^\w.-]+", "_", model_name)
+
+
+@contextlib.contextmanager
+def _file_lock(path):
+    """
+    Exclusive lock between processes sharing a store directory.
+    """
+    with open(path, "a") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class EmbeddingStore:
+    """
+    Persistent embeddings of a single model.
+
+    Vectors are appended to a float32 matrix file which is read back through
+    a memory map, and the row of each text is kept in an index file with one
+    JSON-encoded text per line. Processes may share a store directory:
+    appends are serialized by a file lock and rows come from the files, not
+    from what one process has seen.
+    """
+
+    def __init__(self, model_name, path=DEFAULT_STORE_PATH):
+        self.model_name = model_name
+        self._directory = os.path.join(path, _directory_name(model_name))
+        self._meta_path = os.path.join(self._directory, "meta.json")
+        self._index_path = os.path.join(self._directory, "index.jsonl")
+        self._vectors_path = os.path.join(self._directory, "vectors.f32")
+
+        self._lock_path = os.path.join(self._directory, "lock")
+
+        self._lock = threading.Lock()
+        self._rows = {}
+        self._num_rows = 0
+        self._index_offset = 0
+        self._dim = None
+        self._matrix = None
+
+        os.makedirs(self._directory, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        with self._lock, _file_lock(self._lock_path):
+            self._refresh()
+
+    def _refresh(self):
+        """
+        Index rows appended since the last refresh, by this or another
+        process, and drop a partial write of an interrupted run.
+        Called with the file lock held.
+        """
+        if self._dim is None:
+            if not os.path.exists(self._meta_path):
+                return
+            with open(self._meta_path, "r") as f:
+                self._dim = json.load(f)["dim"]
+
+        if os.path.exists(self._index_path):
+            with open(self._index_path, "rb") as f:
+                f.seek(self._index_offset)
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        # Partially written line of an interrupted run
+                        break
+                    # A text appended twice by racing processes keeps its first row
+                    self._rows.setdefault(json.loads(line), self._num_rows)
+                    self._num_rows += 1
+                    self._index_offset += len(line)
+            if os.path.getsize(self._index_path) != self._index_offset:
+                with open(self._index_path, "ab") as f:
+                    f.truncate(self._index_offset)
+
+        row_bytes = self._dim * np.dtype(np.float32).itemsize
+        num_vectors = self._vectors_size() // row_bytes
+        if num_vectors < self._num_rows:
+            # Index ahead of its vectors; only a damaged store gets here
+            self._rewrite_index(num_vectors)
+        if self._vectors_size() != self._num_rows * row_bytes:
+            # Drop vectors whose index line was never written
+            with open(self._vectors_path, "ab") as f:
+                f.truncate(self._num_rows * row_bytes)
+
+    def _rewrite_index(self, num_rows):
+        with open(self._index_path, "rb") as f:
+            lines = [next(f) for _ in range(num_rows)]
+        with open(self._index_path, "wb") as f:
+            f.writelines(lines)
+
+        self._rows = {}
+        for i, line in enumerate(lines):
+            self._rows.setdefault(json.loads(line), i)
+        self._num_rows = num_rows
+        self._index_offset = sum(len(line) for line in lines)
+
+    def _vectors_size(self):
+        if not os.path.exists(self._vectors_path):
+            return 0
+        return os.path.getsize(self._vectors_path)
+
+    def _vectors(self):
+        """
+        Memory-mapped view of all stored vectors.
+        """
+        if not self._num_rows:
+            return np.empty((0, self._dim or 0), dtype=np.float32)
+        if self._matrix is None or len(self._matrix) != self._num_rows:
+            self._matrix = np.memmap(
+                self._vectors_path,
+                dtype=np.float32,
+                mode="r",
+                shape=(self._num_rows, self._dim),
+            )
+        return self._matrix
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, text):
+        return normalize_text(text) in self._rows
+
+    def get(self, text):
+        """
+        Return stored embedding of given text, or None if it is not stored.
+        """
+        row = self._rows.get(normalize_text(text))
+        if row is None:
+            return None
+        return np.array(self._vectors()[row])
+
+    def put_many(self, texts, vectors):
+        """
+        Append embeddings of given texts. Texts already stored are skipped.
+
+        Appends hold a lock on the store directory and first index the rows
+        other processes appended, so stores sharing a directory stay in sync.
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+
+        with self._lock, _file_lock(self._lock_path):
+            self._refresh()
+            if self._dim is None:
+                self._dim = vectors.shape[1]
+                with open(self._meta_path, "w") as f:
+                    json.dump({"model": self.model_name, "dim": self._dim}, f)
+
+            new_texts = {}
+            for i, text in enumerate(texts):
+                key = normalize_text(text)
+                if key not in self._rows and key not in new_texts:
+                    new_texts[key] = i
+            new_rows = list(new_texts.values())
+
+            if not new_texts:
+                return
+
+            lines = [
+                (json.dumps(key, ensure_ascii=False) + "\n").encode() for key in new_texts
+            ]
+            # Vectors first, so an interrupted write never indexes a missing row
+            with open(self._vectors_path, "ab") as f:
+                f.write(vectors[new_rows].tobytes())
+            with open(self._index_path, "ab") as f:
+                f.writelines(lines)
+
+            for key, line in zip(new_texts, lines):
+                self._rows[key] = self._num_rows
+                self._num_rows += 1
+                self._index_offset += len(line)
+
+    def missing(self, texts):
+        """
+        Texts `embed` would pass to `encode`: the first text of each
+        normalized key missing from the store.
+        """
+        missing = {}
+        for text in texts:
+            key = normalize_text(text)
+            if key not in self._rows and key not in missing:
+                missing[key] = text
+        return list(missing.values())
+
+    def embed(self, texts, encode):
+        """
+        Return embeddings of given texts as a 2D array.
+        Texts missing from the store are embedded with `encode` in one call
+        and stored.
+        """
+        missing = self.missing(texts)
+        if missing:
+            # Another process sharing the directory may have stored them,
+            # even if it was empty when this store was opened
+            with self._lock, _file_lock(self._lock_path):
+                self._refresh()
+            missing = self.missing(texts)
+
+        count("embedding_store.hit", len(texts) - len(missing))
+        count("embedding_store.miss", len(missing))
+        if missing:
+            vectors = encode(missing)
+            with timer("embedding_store.write"):
+                self.put_many(missing, vectors)
+
+        vectors = self._vectors()
+        return np.array(vectors[[self._rows[normalize_text(text)] for text in texts]])
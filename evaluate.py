@@ -1,15 +1,93 @@
-import numpy as np
-from scipy.special import softmax
+import contextlib
+import itertools
+import json
+import os
 import random
+import sys
+from functools import partial
+
+import numpy as np
+
+from embedding_artifact import EmbeddingArtifact, EmbeddingLayers
+from embedding_store import DEFAULT_STORE_PATH, EmbeddingStore, normalize_text
+from instrumentation import Progress, timer
+from score_cache import SCORE_VERSION, fingerprint
+
+
+def cosine_similarity(query, candidates):
+    """
+    Cosine similarity between a vector and each row of a matrix.
+    """
+    similarity = (candidates @ query) / (
+        np.linalg.norm(candidates, axis=1) * np.linalg.norm(query)
+    )
+    # Rounding may push the similarity of identical texts just above 1
+    return np.clip(similarity, -1, 1)
+
+
+def _file_version(path):
+    """
+    Size and modification time of a local model file, or None.
+    """
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
 
 
 class Evaluator:
+    _model_instance = None
+
+    # Whether the same strings always get the same scores, so they can be reused
+    deterministic = True
+
     def name(self):
         """
         Return name of evaluator.
         """
         raise NotImplementedError()
 
+    def load_model(self):
+        """
+        Load the model of the evaluator.
+        Called on first use, so unused evaluators cost nothing to construct.
+        """
+        return None
+
+    def version(self):
+        """
+        JSON data identifying the evaluator and its model.
+        Stored scores are only reused while it is unchanged.
+        """
+        return {"evaluator": self.name(), "score_version": SCORE_VERSION}
+
+    def fingerprint(self):
+        return fingerprint(self.version())
+
+    def prepare(self):
+        """
+        One-time setup before worker processes load the model, such as
+        converting model files.
+        """
+
+    def limit_threads(self, threads):
+        """
+        Limit the threads of the model in a worker process, for libraries
+        that environment variables set after loading do not reach.
+        """
+
+    def __getstate__(self):
+        # Worker processes load their own model instead of receiving a copy
+        state = self.__dict__.copy()
+        state.pop("_model_instance", None)
+        return state
+
+    @property
+    def _model(self):
+        if self._model_instance is None:
+            self._model_instance = self.load_model()
+        return self._model_instance
+
     def similarity(self, s1, s2):
         """
         Evaluate similarity between two strings.
@@ -25,8 +103,129 @@ class Evaluator:
             )
         return value
 
+    def similarity_many(self, query, candidates):
+        """
+        Evaluate similarity between a query string and each of the candidates.
+        Evaluators with a batched backend should override this.
+        """
+        return [self.similarity(query, candidate) for candidate in candidates]
+
+    def safe_similarity_many(self, query, candidates):
+        values = self.similarity_many(query, candidates)
+        for value in values:
+            if value < 0 or value > 1:
+                raise ValueError(
+                    f"Similarity value should be between 0 and 1, but {value} is given."
+                )
+        return values
+
+
+class EmbeddingEvaluator(EmbeddingLayers, Evaluator):
+    """
+    Evaluator which scores strings by cosine similarity of their embeddings.
+    Subclasses only need to implement `encode`.
+    """
+
+    def __init__(self, model_name, store_path=DEFAULT_STORE_PATH):
+        self.model_name = model_name
+        self._store_path = store_path
+        self._store_instance = None
+        self._artifact = None
+        self._encoded = {}
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state["_store_instance"] = None
+        state["_encoded"] = {}
+        return state
+
+    @property
+    def _store(self):
+        if self._store_instance is None and self._store_path is not None:
+            self._store_instance = EmbeddingStore(self.model_name, self._store_path)
+        return self._store_instance
+
+    def encode(self, sentences):
+        """
+        Return embeddings of given sentences as a 2D array, one row per sentence.
+        """
+        raise NotImplementedError()
+
+    def _encode(self, sentences):
+        vectors = self._encoded.pop(tuple(sentences), None)
+        if vectors is not None:
+            return vectors
+        with timer(f"encode.{self.name()}"):
+            return self.encode(sentences)
+
+    def version(self):
+        version = super().version()
+        version["model"] = self.model_name
+        version["model_file"] = _file_version(self.model_name)
+        if self._artifact is not None:
+            # Lossy codecs change scores
+            version["artifact_codec"] = self._artifact.codec.spec
+        return version
+
+    def pending(self, sentences):
+        """
+        Sentences `embeddings` would pass to `encode`, after the artifact
+        and the store.
+        """
+        if self._artifact is not None:
+            sentences = [
+                sentence for sentence in sentences if sentence not in self._artifact
+            ]
+        if self._store is not None:
+            sentences = self._store.missing(sentences)
+        return list(sentences)
+
+    def pending_batches(self, sentences, batch_size=256):
+        """
+        Arguments of every `encode` call `batch_embeddings` would make for
+        given sentences, in order.
+        """
+        stored = set()
+        batches = []
+        for i in range(0, len(sentences), batch_size):
+            batch = self.pending(sentences[i : i + batch_size])
+            if self._store is not None:
+                # Stored by an earlier batch under the same normalized text
+                batch = [
+                    sentence
+                    for sentence in batch
+                    if normalize_text(sentence) not in stored
+                ]
+                stored.update(normalize_text(sentence) for sentence in batch)
+            if batch:
+                batches.append(batch)
+        return batches
+
+    def add_encoded(self, sentences, vectors):
+        """
+        Serve the next `encode` call with exactly these sentences from
+        vectors encoded elsewhere, such as in a worker process.
+        """
+        self._encoded[tuple(sentences)] = vectors
+
+    def embeddings(self, sentences):
+        """
+        Return embeddings of given sentences, reading a precomputed artifact
+        if any and the persistent store so each sentence is encoded only once.
+        """
+        return self._encode_missing(sentences)
+
+    def similarity(self, s1, s2):
+        return self.similarity_many(s1, [s2])[0]
+
+    def similarity_many(self, query, candidates):
+        embeddings = self.embeddings([query] + list(candidates))
+        return cosine_similarity(embeddings[0], embeddings[1:]).tolist()
+
 
 class RandomEvaluator(Evaluator):
+    deterministic = False
+
     def name(self):
         return "RandomEvaluator"
 
@@ -34,86 +233,201 @@ class RandomEvaluator(Evaluator):
         return random.random()
 
 
-class FastTextEvaluator(Evaluator):
-    def __init__(self, model_name):
-        from gensim.models import fasttext
+def convert_fasttext(model_name):
+    """
+    Convert a Facebook fastText `.bin` model to gensim's format once, so it
+    can be memory-mapped. Returns the path of the converted model.
+    """
+    converted = os.path.splitext(model_name)[0] + ".kv"
+    if os.path.exists(converted):
+        return converted
 
-        self._model = fasttext.load_facebook_vectors(model_name)
+    import tempfile
+
+    from gensim.models import fasttext
+
+    # Saved aside and moved into place, so a crash or a worker converting
+    # concurrently never leaves a partial model that later runs would trust
+    directory, name = os.path.split(converted)
+    with tempfile.TemporaryDirectory(dir=directory or ".") as temporary:
+        fasttext.load_facebook_vectors(model_name).save(os.path.join(temporary, name))
+        # gensim writes large arrays to `<name>.<array>.npy` files; the model goes last
+        for filename in sorted(os.listdir(temporary), key=lambda f: f == name):
+            os.replace(
+                os.path.join(temporary, filename), os.path.join(directory, filename)
+            )
+    return converted
+
+
+class FastTextEvaluator(EmbeddingEvaluator):
+    def __init__(self, model_name, store_path=DEFAULT_STORE_PATH, mmap=True):
+        """
+        With `mmap`, the model is converted once and its vectors are
+        memory-mapped, so worker processes share pages instead of each
+        reading the whole model.
+        """
+        super().__init__(model_name, store_path)
+
+        self._mmap = mmap
 
     def name(self):
         return "FastTextEvaluator"
 
-    def similarity(self, s1, s2):
-        return self._model.wv.n_similarity(s1.split(), s2.split())
+    def prepare(self):
+        if self._mmap:
+            convert_fasttext(self.model_name)
 
+    def load_model(self):
+        if self._mmap:
+            from gensim.models.fasttext import FastTextKeyedVectors
 
-class PororoEvaluator(Evaluator):
-    def __init__(self):
-        from pororo import Pororo
+            return FastTextKeyedVectors.load(
+                convert_fasttext(self.model_name), mmap="r"
+            )
+
+        from gensim.models import fasttext
+
+        return fasttext.load_facebook_vectors(self.model_name)
 
-        self._model = Pororo(task="similarity", lang="ko")
+    def encode(self, sentences):
+        vectors = getattr(self._model, "wv", self._model)
 
+        # Same mean word vector as `n_similarity` uses
+        return np.array(
+            [np.mean(vectors[sentence.split()], axis=0) for sentence in sentences]
+        )
+
+
+class PororoEvaluator(Evaluator):
     def name(self):
         return "PororoEvaluator"
 
+    def load_model(self):
+        from pororo import Pororo
+
+        return Pororo(task="similarity", lang="ko")
+
     def similarity(self, s1, s2):
         return self._model(s1, s2)
 
 
-class SentenceBertEvaluator(Evaluator):
-    def __init__(self, model_name):
-        from sentence_transformers import SentenceTransformer
+class SentenceBertEvaluator(EmbeddingEvaluator):
+    def __init__(
+        self, model_name, store_path=DEFAULT_STORE_PATH, backend="torch", **options
+    ):
+        """
+        With backend "onnx", the model runs through ONNX Runtime with
+        `options` of `OnnxSentenceEncoder`.
+        """
+        self._model_path = model_name
+        self._backend = backend
+        self._options = options
+        self._threads = None
 
-        self._model = SentenceTransformer(model_name)
+        self._variant = None
+        if backend == "onnx":
+            # Stored apart from the PyTorch embeddings, which differ slightly
+            self._variant = "onnx-int8" if options.get("quantize", True) else "onnx"
+            model_name = f"{model_name}@{self._variant}"
+
+        super().__init__(model_name, store_path)
 
     def name(self):
-        return "SentenceBertEvaluator"
+        if self._variant is None:
+            return "SentenceBertEvaluator"
+        # Reported apart from the PyTorch backend
+        return f"SentenceBertEvaluator ({self._variant})"
 
-    def similarity(self, s1, s2):
-        from sentence_transformers import util
+    def version(self):
+        version = super().version()
+        version["model_file"] = _file_version(self._model_path)
+        version["options"] = self._options
+        return version
 
-        s1_embedding = self._model.encode(s1)
-        s2_embedding = self._model.encode(s2)
+    def prepare(self):
+        if self._backend == "onnx":
+            # Exported once, instead of by every worker at the same time
+            from onnx_backend import DEFAULT_EXPORT_PATH, exported_model
 
-        return util.pytorch_cos_sim(s1_embedding, s2_embedding)[0][0]
+            exported_model(
+                self._model_path,
+                self._options.get("export_path", DEFAULT_EXPORT_PATH),
+            )
 
+    def limit_threads(self, threads):
+        # ONNX Runtime sizes its thread pool from the session options
+        self._threads = threads
 
-class OpenAIEvaluator(Evaluator):
-    def __init__(self, model_name):
-        from openai import OpenAI
-        
-        self._client = OpenAI()
-        self.model_name = model_name
-    
+    def load_model(self):
+        if self._backend == "onnx":
+            from onnx_backend import OnnxSentenceEncoder
+
+            options = dict(self._options)
+            if self._threads is not None:
+                options.setdefault("num_threads", self._threads)
+            return OnnxSentenceEncoder(self._model_path, **options)
+
+        from sentence_transformers import SentenceTransformer
+
+        return SentenceTransformer(self._model_path)
+
+    def encode(self, sentences):
+        return self._model.encode(sentences)
+
+
+class OpenAIEvaluator(EmbeddingEvaluator):
     def name(self):
         return "OpenAIEvaluator"
-    
-    def similarity(self, s1, s2):
-        response = self._client.embeddings.create(
-            input=[s1, s2],
-            model=self.model_name
-        )
-        
-        s1_embedding = response.data[0].embedding
-        s2_embedding = response.data[1].embedding
-        
-        return np.dot(s1_embedding, s2_embedding) / (
-            np.linalg.norm(s1_embedding) * np.linalg.norm(s2_embedding)
+
+    def load_model(self):
+        from api_client import create_client
+
+        return create_client()
+
+    def encode(self, sentences):
+        response = self._model.embeddings.create(
+            input=list(sentences), model=self.model_name
         )
 
+        return np.array([item.embedding for item in response.data], dtype=np.float32)
+
+
+# Evaluators selectable from the command line
+EVALUATORS = {
+    "random": RandomEvaluator,
+    "fasttext": partial(
+        FastTextEvaluator, "./vector_embedding/fasttext/models/cc.ko.300.bin"
+    ),
+    "openai": partial(OpenAIEvaluator, "text-embedding-ada-002"),
+    "pororo": PororoEvaluator,
+    "sentence_bert": partial(SentenceBertEvaluator, "jhgan/ko-sroberta-multitask"),
+    "sentence_bert_onnx": partial(
+        SentenceBertEvaluator, "jhgan/ko-sroberta-multitask", backend="onnx"
+    ),
+}
+
 
 class LabeledData:
-    def __init__(self, json):
-        self._json = json
+    __slots__ = ("intent", "prompt", "choices", "label")
 
+    def __init__(self, json):
         self.intent = json["intent"]
         self.prompt = json["prompt"]
         self.choices = [item["text"] for item in json["choices"]]
 
+        label_id = json["choice"]["nextSectionId"]
         for i, choice in enumerate(json["choices"]):
-            if choice["nextSectionId"] == json["choice"]["nextSectionId"]:
+            if choice["nextSectionId"] == label_id:
                 self.label = i
                 break
+        else:
+            raise ValueError(f"Choice {label_id} is not one of the choices")
+
+    def fingerprint(self):
+        """
+        Content address of the intent, choices and label of this row.
+        """
+        return fingerprint([self.intent, self.choices, self.label])
 
     def __str__(self):
         return f"LabeledData(intent={self.intent}, prompt={self.prompt}, choices={self.choices}, label={self.label})"
@@ -121,86 +435,809 @@ class LabeledData:
     def __repr__(self):
         return str(self)
     
-    def predict(self, evaluator):
-        similarity = [
-            evaluator.safe_similarity(self.intent, choice) for choice in self.choices
-        ]
-        
+    def similarity(self, evaluator):
+        """
+        Similarity between the intent and each choice.
+        Metrics below accept this vector so an item is scored only once.
+        """
+        return np.asarray(evaluator.safe_similarity_many(self.intent, self.choices))
+
+    def predict(self, evaluator=None, similarity=None):
+        if similarity is None:
+            similarity = self.similarity(evaluator)
+
         return np.argmax(similarity)
 
-    def cross_entropy_loss(self, evaluator, print_details=False):
-        similarity = [
-            evaluator.safe_similarity(self.intent, choice) for choice in self.choices
-        ]
-        softmax_similarity = softmax(similarity)
-        loss = -np.log(softmax_similarity[self.label])
-        
+    def cross_entropy_loss(self, evaluator=None, print_details=False, similarity=None):
+        if similarity is None:
+            similarity = self.similarity(evaluator)
+        loss = cross_entropy_loss(similarity, self.label)
+
         if print_details:
             print(self.intent, self.choices, similarity, self.label, loss)
-            
+
         return loss
-    
-    def cosine_similarity_loss(self, evaluator, print_details=False):
-        similarity = [
-            evaluator.safe_similarity(self.intent, choice) for choice in self.choices
-        ]
-        
-        loss = 0
-        for i, sim in enumerate(similarity):
-            if i == self.label:
-                loss += 1 - sim
-            else:
-                loss += sim
-        
+
+    def cosine_similarity_loss(
+        self, evaluator=None, print_details=False, similarity=None
+    ):
+        if similarity is None:
+            similarity = self.similarity(evaluator)
+        loss = cosine_similarity_loss(similarity, self.label)
+
         if print_details:
             print(self.intent, self.choices, similarity, self.label, loss)
-        
+
         return loss
 
 
-def load_label_data(filename):
-    import json
+def cross_entropy_loss(similarity, label):
+    # -log(softmax(similarity)[label]) without importing scipy
+    similarity = np.asarray(similarity, dtype=np.float64)
+    row_max = np.max(similarity)
+    logsumexp = row_max + np.log(np.sum(np.exp(similarity - row_max)))
+    return logsumexp - similarity[label]
+
+
+def cosine_similarity_loss(similarity, label):
+    loss = 0
+    for i, sim in enumerate(similarity):
+        if i == label:
+            loss += 1 - sim
+        else:
+            loss += sim
+    return loss
+
+
+def top_k_correct(similarity, label, k):
+    """
+    Whether the label is among the k most similar choices.
+    Ties are broken like `np.argmax`, so top-1 matches `predict`.
+    """
+    return label in np.argsort(-np.asarray(similarity), kind="stable")[:k]
+
+
+class EvaluationResult:
+    """
+    Accumulates metrics of an evaluator from per-item similarity vectors.
+    """
+
+    def __init__(self, name, top_k=(1, 3)):
+        self.name = name
+        self.top_k = top_k
+        self.tries = 0
+        self.loss = 0
+        self.cosine_loss = 0
+        self.correct = {k: 0 for k in top_k}
+
+    def add(self, label, similarity):
+        self.tries += 1
+        self.loss += cross_entropy_loss(similarity, label)
+        self.cosine_loss += cosine_similarity_loss(similarity, label)
+        for k in self.top_k:
+            if top_k_correct(similarity, label, k):
+                self.correct[k] += 1
+
+    def add_many(self, losses, cosine_losses, ranks):
+        """
+        Add metrics of many items at once, as computed by `batch_metrics`.
+        """
+        self.tries += len(ranks)
+        self.loss += float(np.sum(losses))
+        self.cosine_loss += float(np.sum(cosine_losses))
+        for k in self.top_k:
+            self.correct[k] += int(np.sum(ranks < k))
 
+    def merge(self, other):
+        """
+        Add metrics accumulated by another result of the same evaluator.
+        """
+        self.tries += other.tries
+        self.loss += other.loss
+        self.cosine_loss += other.cosine_loss
+        for k in self.top_k:
+            self.correct[k] += other.correct[k]
+
+    def accuracy(self, k=1):
+        return self.correct[k] / self.tries
+
+    def report(self):
+        print(f"Loss for {self.name}: {self.loss}")
+        print(f"Cosine similarity loss for {self.name}: {self.cosine_loss}")
+        print(f"Accuracy for {self.name}: {self.accuracy()}")
+        for k in self.top_k:
+            if k != 1:
+                print(f"Top-{k} accuracy for {self.name}: {self.accuracy(k)}")
+
+
+def evaluate(evaluator, data, top_k=(1, 3)):
+    """
+    Score every item once and compute all metrics from the same similarities.
+    """
+    result = EvaluationResult(evaluator.name(), top_k)
+    progress = Progress(len(data), f"Evaluating {evaluator.name()}")
+    for i, item in enumerate(data):
+        with timer("similarity"):
+            similarity = item.similarity(evaluator)
+        with timer("metrics"):
+            result.add(item.label, similarity)
+
+        if i % 10 == 0:
+            loss = cross_entropy_loss(similarity, item.label)
+            print(item.intent, item.choices, similarity, item.label, loss)
+        progress.update()
+
+    return result
+
+
+def _padded(rows, dtype):
+    """
+    Pack ragged rows into a zero-padded matrix and its mask.
+    """
+    width = max((len(row) for row in rows), default=0)
+    padded = np.zeros((len(rows), width), dtype=dtype)
+    mask = np.zeros((len(rows), width), dtype=bool)
+    for i, row in enumerate(rows):
+        padded[i, : len(row)] = row
+        mask[i, : len(row)] = True
+    return padded, mask
+
+
+def batch_embeddings(evaluator, texts, batch_size=256):
+    """
+    Embed texts in batches of `batch_size` and normalize them to unit length.
+    """
+    if not texts:
+        return np.empty((0, 0))
+    progress = Progress(len(texts), f"Embedding for {evaluator.name()}")
+    batches = []
+    for i in range(0, len(texts), batch_size):
+        batch = texts[i : i + batch_size]
+        with timer("embed"):
+            batches.append(np.asarray(evaluator.embeddings(batch), dtype=np.float64))
+        progress.update(len(batch))
+    embeddings = np.concatenate(batches)
+    return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+
+class IndexedDataset:
+    """
+    Labeled data with every unique intent and choice string collected once,
+    so several evaluators can score it without re-walking the items.
+    """
+
+    def __init__(self, data):
+        self.data = data
+
+        text_ids = {}
+        intent_ids = [text_ids.setdefault(item.intent, len(text_ids)) for item in data]
+        choice_ids = [
+            [text_ids.setdefault(choice, len(text_ids)) for choice in item.choices]
+            for item in data
+        ]
+
+        self.texts = list(text_ids)
+        self.intent_ids = np.array(intent_ids, dtype=np.int64)
+        self.choice_ids, self.mask = _padded(choice_ids, np.int64)
+        self.labels = np.array([item.label for item in data], dtype=np.int64)
+
+    def __len__(self):
+        return len(self.data)
+
+
+def score_dataset(evaluator, data, batch_size=256, chunk_size=1024):
+    """
+    Similarity of every item's intent to each of its choices.
+    `data` is a list of labeled data or an `IndexedDataset`.
+
+    Embedding evaluators embed every unique string of the dataset once and
+    score all items with gathered matrix products. Other evaluators are
+    scored item by item.
+
+    Returns the similarities padded to a matrix, together with its mask.
+    """
+    if not isinstance(data, IndexedDataset):
+        data = IndexedDataset(data)
+
+    if not isinstance(evaluator, EmbeddingEvaluator):
+        with timer("similarity"):
+            return _padded(
+                [item.similarity(evaluator) for item in data.data], np.float64
+            )
+
+    embeddings = batch_embeddings(evaluator, data.texts, batch_size)
+    with timer("score"):
+        similarity = score_embeddings(embeddings, data, chunk_size)
+
+    if np.any((similarity < 0)[data.mask]) or np.any((similarity > 1)[data.mask]):
+        value = similarity[data.mask & ((similarity < 0) | (similarity > 1))][0]
+        raise ValueError(
+            f"Similarity value should be between 0 and 1, but {value} is given."
+        )
+
+    return similarity, data.mask
+
+
+def score_embeddings(embeddings, data, chunk_size=1024):
+    """
+    Similarity of every item's intent to each of its choices, given unit
+    embeddings of `data.texts` of an `IndexedDataset`, clipped to [-1, 1].
+    """
+    intent_ids, choice_ids = data.intent_ids, data.choice_ids
+
+    similarity = np.empty(choice_ids.shape)
+    for start in range(0, len(data), chunk_size):
+        end = start + chunk_size
+        similarity[start:end] = np.einsum(
+            "nd,nmd->nm",
+            embeddings[intent_ids[start:end]],
+            embeddings[choice_ids[start:end]],
+        )
+    return np.clip(similarity, -1, 1, out=similarity)
+
+
+def batch_metrics(similarity, mask, labels):
+    """
+    Cross entropy loss, cosine similarity loss and rank of the label for
+    every row of padded similarities.
+    """
+    rows = np.arange(len(labels))
+    masked = np.where(mask, similarity, -np.inf)
+    label_similarity = similarity[rows, labels]
+
+    # log(softmax(x)[label]) = x[label] - logsumexp(x)
+    row_max = np.max(masked, axis=1, keepdims=True)
+    logsumexp = row_max[:, 0] + np.log(np.sum(np.exp(masked - row_max), axis=1))
+    losses = logsumexp - label_similarity
+
+    cosine_losses = (
+        np.sum(np.where(mask, similarity, 0), axis=1) - 2 * label_similarity + 1
+    )
+
+    # Ties are broken like `np.argmax`, as in `top_k_correct`
+    columns = np.arange(similarity.shape[1])
+    ranks = np.sum(
+        mask
+        & (
+            (masked > label_similarity[:, None])
+            | ((masked == label_similarity[:, None]) & (columns < labels[:, None]))
+        ),
+        axis=1,
+    )
+
+    return losses, cosine_losses, ranks
+
+
+def evaluate_dataset(evaluator, data, top_k=(1, 3), batch_size=256):
+    """
+    Vectorized counterpart of `evaluate`.
+    `data` is a list of labeled data or an `IndexedDataset`.
+    """
+    if not isinstance(data, IndexedDataset):
+        data = IndexedDataset(data)
+
+    similarity, mask = score_dataset(evaluator, data, batch_size)
+
+    result = EvaluationResult(evaluator.name(), top_k)
+    with timer("metrics"):
+        result.add_many(*batch_metrics(similarity, mask, data.labels))
+    return result
+
+
+def evaluate_incremental(evaluator, data, score_cache, top_k=(1, 3), batch_size=256):
+    """
+    Counterpart of `evaluate_dataset` reusing per-row metrics stored in
+    `score_cache` for rows whose intent, choices and label were already
+    scored by the same evaluator and model. Only new or changed rows are
+    scored, and their metrics are stored for the next run.
+    """
+    if not evaluator.deterministic:
+        return evaluate_dataset(evaluator, data, top_k, batch_size)
+
+    data = data.data if isinstance(data, IndexedDataset) else list(data)
+    evaluator_key = evaluator.fingerprint()
+    row_keys = [item.fingerprint() for item in data]
+    with timer("load"):
+        scores = score_cache.get_many(evaluator_key, row_keys)
+
+    # Rows of the same content are scored once
+    missing = {}
+    for i, key in enumerate(row_keys):
+        if key not in scores and key not in missing:
+            missing[key] = i
+    print(
+        f"{evaluator.name()}: scoring {len(missing)} new or changed rows, "
+        f"reusing {len(data) - len(missing)}"
+    )
+
+    if missing:
+        changed = IndexedDataset([data[i] for i in missing.values()])
+        similarity, mask = score_dataset(evaluator, changed, batch_size)
+        with timer("metrics"):
+            metrics = batch_metrics(similarity, mask, changed.labels)
+        new_scores = list(zip(missing, *metrics))
+        score_cache.put_many(evaluator_key, new_scores)
+        for key, loss, cosine_loss, rank in new_scores:
+            scores[key] = (loss, cosine_loss, rank)
+
+    rows = [scores[key] for key in row_keys]
+    losses = np.array([row[0] for row in rows], dtype=np.float64)
+    cosine_losses = np.array([row[1] for row in rows], dtype=np.float64)
+    ranks = np.array([row[2] for row in rows], dtype=np.int64)
+
+    result = EvaluationResult(evaluator.name(), top_k)
+    result.add_many(losses, cosine_losses, ranks)
+    return result
+
+
+_worker_evaluator = None
+
+
+def _limit_threads(threads):
+    """
+    Limit the threads of numerical libraries in a worker process.
+    """
+    # Read by libraries the worker imports after the fork
+    for variable in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+        os.environ[variable] = str(threads)
+
+    # Libraries the parent had already loaded keep their thread pools
+    if "torch" in sys.modules:
+        sys.modules["torch"].set_num_threads(threads)
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return
+    threadpool_limits(threads)
+
+
+def _init_worker(evaluator, threads=None):
+    global _worker_evaluator
+    if threads is not None:
+        _limit_threads(threads)
+        evaluator.limit_threads(threads)
+    _worker_evaluator = evaluator
+
+
+def _evaluate_in_worker(dataset, top_k):
+    return evaluate_dataset(_worker_evaluator, dataset, top_k)
+
+
+class EvaluatorPool:
+    """
+    Worker processes holding their own copy of an evaluator, which loads its
+    model on first use and keeps it for every dataset submitted afterwards.
+    Use it as a context manager, or `close` it.
+    """
+
+    def __init__(self, evaluator, workers=1, threads=None):
+        from concurrent.futures import ProcessPoolExecutor
+
+        evaluator.prepare()
+        self.evaluator = evaluator
+        self.workers = workers
+        self._executor = ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker, initargs=(evaluator, threads)
+        )
+
+    def submit(self, function, *args):
+        return self._executor.submit(function, *args)
+
+    def map(self, function, iterable):
+        return self._executor.map(function, iterable)
+
+    def close(self):
+        self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def compare_evaluators(evaluators, data, top_k=(1, 3), processes=False, pools=None):
+    """
+    Evaluate several evaluators on the same data, indexing it only once.
+
+    With `processes`, each evaluator is sent to its own worker process before
+    loading its model, so a sweep takes about as long as the slowest
+    evaluator. Passing `pools`, one `EvaluatorPool` per evaluator, reuses
+    the loaded models across calls. Results keep the order of `evaluators`.
+    """
+    dataset = IndexedDataset(data)
+
+    if pools is None and not processes:
+        return [evaluate_dataset(evaluator, dataset, top_k) for evaluator in evaluators]
+
+    with contextlib.ExitStack() as stack:
+        if pools is None:
+            pools = [
+                stack.enter_context(EvaluatorPool(evaluator)) for evaluator in evaluators
+            ]
+        futures = [pool.submit(_evaluate_in_worker, dataset, top_k) for pool in pools]
+        return [future.result() for future in futures]
+
+
+def _markdown_table(header, rows):
+    lines = ["| " + " | ".join(header) + " |"]
+    lines.append("| " + " | ".join("-" * len(column) for column in header) + " |")
+    for row in rows:
+        lines.append("| " + " | ".join(row) + " |")
+    return "\n".join(lines)
+
+
+class CodecComparison:
+    """
+    Results of one evaluator with its embeddings stored as they are and as
+    each codec stores them.
+    """
+
+    def __init__(self, baseline, dim):
+        self.baseline = baseline
+        self.dim = dim
+        self.variants = []
+
+    def table(self):
+        """
+        Markdown table of stored size, loss and accuracy of each codec, and
+        their changes from full precision.
+        """
+        header = ["Storage", "Bytes/vector", "Loss", "Δ Loss"]
+        for k in self.baseline.top_k:
+            header += [f"Top-{k} accuracy", f"Δ Top-{k}"]
+
+        rows = []
+        for codec, result in [(None, self.baseline)] + self.variants:
+            row = [
+                "float32" if codec is None else codec.spec,
+                str(self.dim * 4 if codec is None else codec.bytes_per_vector(self.dim)),
+                f"{result.loss:.3f}",
+                f"{result.loss - self.baseline.loss:+.3f}",
+            ]
+            for k in self.baseline.top_k:
+                accuracy = result.accuracy(k)
+                row += [f"{accuracy:.3f}", f"{accuracy - self.baseline.accuracy(k):+.3f}"]
+            rows.append(row)
+
+        return f"{self.baseline.name}:\n" + _markdown_table(header, rows)
+
+
+def compare_codecs(evaluator, data, codecs, top_k=(1, 3), batch_size=256):
+    """
+    Evaluate an embedding evaluator with its embeddings as they are and
+    after a storage round trip through each codec, given as specs like
+    "int8+pca:256". The data is embedded only once. PCA codecs are fitted on
+    the embeddings of the data itself, as precompute.py fits them on the
+    texts it stores.
+    """
+    from embedding_codec import EmbeddingCodec
+
+    if not isinstance(data, IndexedDataset):
+        data = IndexedDataset(data)
+
+    def evaluate_embeddings(name, embeddings):
+        similarity = score_embeddings(embeddings, data)
+        result = EvaluationResult(name, top_k)
+        result.add_many(*batch_metrics(similarity, data.mask, data.labels))
+        return result
+
+    embeddings = batch_embeddings(evaluator, data.texts, batch_size)
+    comparison = CodecComparison(
+        evaluate_embeddings(evaluator.name(), embeddings), embeddings.shape[1]
+    )
+
+    for spec in codecs:
+        codec = EmbeddingCodec.parse(spec).fit(embeddings)
+        stored = codec.round_trip(embeddings).astype(np.float64)
+        stored /= np.linalg.norm(stored, axis=1, keepdims=True)
+        comparison.variants.append(
+            (codec, evaluate_embeddings(f"{evaluator.name()} [{codec}]", stored))
+        )
+
+    return comparison
+
+
+def _encode_batch(sentences):
+    return np.asarray(_worker_evaluator.encode(sentences))
+
+
+def _similarity_shard(items):
+    return [item.similarity(_worker_evaluator) for item in items]
+
+
+def evaluate_sharded(
+    evaluator, data, top_k=(1, 3), workers=None, batch_size=256, pool=None
+):
+    """
+    Multi-process counterpart of `evaluate_dataset` for CPU-bound local models.
+    `data` is a list of labeled data or an `IndexedDataset`.
+
+    Each of the `workers` processes (all cores by default) loads the model
+    once. Embedding evaluators spread the very `encode` calls of a
+    single-process run across workers, and the gathered embeddings are
+    scored here; other evaluators score contiguous shards of items. Partial
+    results are merged in dataset order, so the result matches
+    `evaluate_dataset` exactly as long as the model encodes a batch
+    deterministically.
+
+    Pass a `sharded_pool` of the evaluator to keep its workers, and their
+    loaded models, across datasets.
+    """
+    if not isinstance(data, IndexedDataset):
+        data = IndexedDataset(data)
+
+    with contextlib.ExitStack() as stack:
+        if pool is None:
+            pool = stack.enter_context(sharded_pool(evaluator, workers))
+        return _evaluate_sharded(evaluator, data, top_k, batch_size, pool)
+
+
+def sharded_pool(evaluator, workers=None):
+    """
+    `EvaluatorPool` of `workers` processes (all cores by default) sharing
+    the cores, for `evaluate_sharded`.
+    """
+    if workers is None:
+        workers = os.cpu_count()
+    return EvaluatorPool(evaluator, workers, max(1, os.cpu_count() // workers))
+
+
+def _evaluate_sharded(evaluator, data, top_k, batch_size, pool):
+    if isinstance(evaluator, EmbeddingEvaluator):
+        batches = evaluator.pending_batches(data.texts, batch_size)
+        progress = Progress(len(batches), f"Encoding batches for {evaluator.name()}")
+        for batch, vectors in zip(batches, pool.map(_encode_batch, batches)):
+            evaluator.add_encoded(batch, vectors)
+            progress.update()
+        return evaluate_dataset(evaluator, data, top_k, batch_size)
+
+    shard_size = max(1, -(-len(data) // (pool.workers * 4)))
+    shards = [data.data[i : i + shard_size] for i in range(0, len(data), shard_size)]
+    progress = Progress(len(data), f"Evaluating {evaluator.name()}")
+    similarities = []
+    for shard in pool.map(_similarity_shard, shards):
+        similarities += shard
+        progress.update(len(shard))
+
+    similarity, mask = _padded(similarities, np.float64)
+    result = EvaluationResult(evaluator.name(), top_k)
+    with timer("metrics"):
+        result.add_many(*batch_metrics(similarity, mask, data.labels))
+    return result
+
+
+def results_table(results_by_dataset):
+    """
+    Markdown table of loss and accuracy of each evaluator on each dataset,
+    given as a dict from dataset name to a list of results.
+    """
+    names = []
+    for results in results_by_dataset.values():
+        for result in results:
+            if result.name not in names:
+                names.append(result.name)
+
+    header = ["Embedding"]
+    for dataset in results_by_dataset:
+        header += [f"Loss (`{dataset}`)", f"Accuracy (`{dataset}`)"]
+
+    rows = []
+    for name in names:
+        row = [name]
+        for results in results_by_dataset.values():
+            result = next((r for r in results if r.name == name), None)
+            if result is None:
+                row += ["", ""]
+            else:
+                row += [f"{result.loss:.3f}", f"{result.accuracy():.3f}"]
+        rows.append(row)
+
+    return _markdown_table(header, rows)
+
+
+def evaluate_stream(evaluator, data, top_k=(1, 3), chunk_size=10000):
+    """
+    Evaluate an iterable of items in chunks of `chunk_size`, so memory use
+    does not grow with the size of the dataset.
+    """
+    data = iter(data)
+    result = EvaluationResult(evaluator.name(), top_k)
+    progress = Progress(label=f"Evaluating {evaluator.name()}", interval=0)
+    while True:
+        with timer("load"):
+            chunk = list(itertools.islice(data, chunk_size))
+        if not chunk:
+            return result
+        result.merge(evaluate_dataset(evaluator, chunk, top_k))
+        progress.update(len(chunk))
+
+
+def iter_label_data(filename):
+    """
+    Yield labeled data of a file one item at a time.
+    JSONL files, such as the `.log` files written by label.py, are streamed
+    line by line. JSON arrays are loaded at once.
+    """
     with open(filename, "r") as f:
-        data = json.load(f)
-        return [LabeledData(item) for item in data]
+        first = f.read(1)
+        while first.isspace():
+            first = f.read(1)
+        f.seek(0)
+
+        if first == "[":
+            for item in json.load(f):
+                yield LabeledData(item)
+            return
+
+        for line in f:
+            if line.strip():
+                yield LabeledData(json.loads(line))
+
+
+def load_label_data(filename):
+    with timer("load"):
+        return list(iter_label_data(filename))
 
 
 if __name__ == "__main__":
-    import sys
+    import argparse
 
-    if len(sys.argv) != 2:
-        print("Usage: python evaluate.py <data_filename>")
-        exit(1)
+    from embedding_codec import EmbeddingCodec
+    from instrumentation import PROFILERS, STATS, profile
+    from score_cache import DEFAULT_SCORE_CACHE_PATH, ScoreCache
 
-    data_filename = sys.argv[1]
+    parser = argparse.ArgumentParser(description="Evaluate vector embeddings")
+    parser.add_argument("data_filenames", nargs="+")
+    parser.add_argument(
+        "--evaluators",
+        default="random,openai",
+        help=f"comma-separated evaluators among {', '.join(EVALUATORS)}",
+    )
+    parser.add_argument(
+        "--processes",
+        action="store_true",
+        help="run each evaluator in its own worker process",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="stream the data in chunks instead of loading it at once",
+    )
+    parser.add_argument(
+        "--artifact",
+        action="append",
+        default=[],
+        help="precomputed embeddings of precompute.py, used by the evaluator of its model",
+    )
+    parser.add_argument(
+        "--codecs",
+        default="",
+        help="comma-separated storage codecs to compare, such as float16,int8,int8+pca:256",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="reuse stored scores of unchanged rows and score only new or changed ones",
+    )
+    parser.add_argument(
+        "--score-cache",
+        default=None,
+        help="SQLite file of stored scores (default: $EVALUATION_CACHE_PATH)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="split each evaluator's work across this many processes",
+    )
+    parser.add_argument("--profile", choices=PROFILERS, default=None)
+    parser.add_argument(
+        "--profile-output", default=None, help="file to write the profile to"
+    )
+    args = parser.parse_args()
+
+    if args.workers is not None and (args.processes or args.stream):
+        parser.error("--workers can't be combined with --processes or --stream")
+    if args.incremental and (args.processes or args.stream or args.workers is not None):
+        parser.error(
+            "--incremental can't be combined with --processes, --stream or --workers"
+        )
+
+    # Results are reported by file name without extension
+    datasets = {}
+    for data_filename in args.data_filenames:
+        dataset = os.path.splitext(os.path.basename(data_filename))[0]
+        if dataset in datasets:
+            parser.error(
+                f"{datasets[dataset]} and {data_filename} would both be reported as {dataset}"
+            )
+        datasets[dataset] = data_filename
 
-    data = load_label_data(data_filename)
+    codecs = [spec.strip() for spec in args.codecs.split(",") if spec.strip()]
+    if codecs and args.stream:
+        parser.error("--codecs needs the data loaded at once, without --stream")
+    for spec in codecs:
+        try:
+            EmbeddingCodec.parse(spec)
+        except ValueError as error:
+            parser.error(f"Invalid codec {spec}: {error}")
 
-    # Stats for data
-    print(f"Total data: {len(data)}")
+    evaluator_names = [name.strip() for name in args.evaluators.split(",")]
+    for name in evaluator_names:
+        if name not in EVALUATORS:
+            parser.error(f"Unknown evaluator {name}")
+    evaluators = [EVALUATORS[name]() for name in evaluator_names]
 
-    evaluators = [
-        RandomEvaluator(),
-        # FastTextEvaluator("./vector_embedding/fasttext/models/cc.ko.300.bin"),
-        # PororoEvaluator(),
-        # SentenceBertEvaluator("jhgan/ko-sroberta-multitask"),
-        OpenAIEvaluator("text-embedding-ada-002")
-    ]
+    for artifact_path in args.artifact:
+        model_name = EmbeddingArtifact(artifact_path).model_name
+        matched = [
+            evaluator
+            for evaluator in evaluators
+            if getattr(evaluator, "model_name", None) == model_name
+        ]
+        if not matched:
+            parser.error(f"No evaluator uses the model {model_name} of {artifact_path}")
+        for evaluator in matched:
+            evaluator.use_artifact(artifact_path)
 
     # Calculate loss and accuracy
-    for evaluator in evaluators:
-        loss = 0
-        tries = 0
-        correct = 0
-        for i, item in enumerate(data):
-            loss += item.cross_entropy_loss(evaluator, print_details=i % 10 == 0)
-            tries += 1
-            if item.predict(evaluator) == item.label:
-                correct += 1
-                
-            if i % 10 == 0:
-                print(f"Progress: {i} / {len(data)}")
-
-        print(f"Loss for {evaluator.name()}: {loss}")
-        print(f"Accuracy for {evaluator.name()}: {correct / tries}")
+    results_by_dataset = {}
+    with profile(args.profile, args.profile_output), contextlib.ExitStack() as stack:
+        pools = None
+        if args.processes:
+            # Each model is loaded once in its own process, for every file
+            pools = [
+                stack.enter_context(EvaluatorPool(evaluator)) for evaluator in evaluators
+            ]
+
+        sharded_results = {filename: [] for filename in args.data_filenames}
+        if args.workers is not None:
+            # One evaluator's workers at a time, each loading the model once for
+            # every file, so only one model is held per core
+            for evaluator in evaluators:
+                with sharded_pool(evaluator, args.workers) as pool:
+                    for data_filename in args.data_filenames:
+                        dataset = IndexedDataset(load_label_data(data_filename))
+                        sharded_results[data_filename].append(
+                            evaluate_sharded(evaluator, dataset, pool=pool)
+                        )
+
+        for dataset, data_filename in datasets.items():
+            if args.stream:
+                results = []
+                for evaluator in evaluators:
+                    results.append(
+                        evaluate_stream(evaluator, iter_label_data(data_filename))
+                    )
+            elif args.incremental:
+                data = load_label_data(data_filename)
+                score_cache = ScoreCache(args.score_cache or DEFAULT_SCORE_CACHE_PATH)
+                results = [
+                    evaluate_incremental(evaluator, data, score_cache)
+                    for evaluator in evaluators
+                ]
+            elif args.workers is not None:
+                data = load_label_data(data_filename) if codecs else None
+                results = sharded_results[data_filename]
+            else:
+                data = load_label_data(data_filename)
+                results = compare_evaluators(evaluators, data, pools=pools)
+
+            # Stats for data
+            print(f"Total data ({data_filename}): {results[0].tries}")
+            for result in results:
+                result.report()
+
+            results_by_dataset[dataset] = results
+
+            # Change of loss and accuracy with compact storage
+            for evaluator in evaluators:
+                if codecs and isinstance(evaluator, EmbeddingEvaluator):
+                    print()
+                    print(compare_codecs(evaluator, data, codecs).table())
+
+    print()
+    print(results_table(results_by_dataset))
+    print()
+    print(STATS.report())
@@ -0,0 +1,76 @@
+import weakref
+
+
+# Views of the graphs they were built from, so `of` builds each one once
+_views = weakref.WeakKeyDictionary()
+
+
+def _node_id(node):
+    return getattr(node, "id", node)
+
+
+class GraphView:
+    """
+    Lookups of a chatbot graph precomputed once per chatbot file.
+
+    Provides the same `name`, `root`, `node`, `vertices` and `edges_of`
+    accessors as the graph, so it can be passed wherever the graph is used.
+    Nodes may be given as node objects or node ids.
+    """
+
+    def __init__(self, graph):
+        self.graph = graph
+        self.name = graph.name
+
+        self._root = graph.root()
+        self._vertices = list(graph.vertices())
+        self._nodes = {node.id: node for node in self._vertices}
+        self._edges = {node.id: list(graph.edges_of(node)) for node in self._vertices}
+        self._labels = {}
+        for node_id, edges in self._edges.items():
+            labels = self._labels[node_id] = {}
+            for edge in edges:
+                # The first edge of a duplicated label wins, as in a linear scan
+                labels.setdefault(edge.text(), edge)
+
+        self.branching_nodes = [
+            node for node in self._vertices if len(self._edges[node.id]) >= 2
+        ]
+
+    @classmethod
+    def of(cls, graph):
+        """
+        Return the graph itself if it is already a view, or its view built
+        on first use.
+        """
+        if isinstance(graph, cls):
+            return graph
+        try:
+            view = _views.get(graph)
+        except TypeError:
+            # Graphs that can't be weakly referenced are not cached
+            return cls(graph)
+        if view is None:
+            view = _views[graph] = cls(graph)
+        return view
+
+    def root(self):
+        return self._root
+
+    def node(self, node_id):
+        return self._nodes[node_id]
+
+    def vertices(self):
+        return self._vertices
+
+    def edges_of(self, node):
+        return self._edges.get(_node_id(node), [])
+
+    def edge_labels(self, node):
+        return list(self._labels.get(_node_id(node), {}))
+
+    def edge_by_label(self, node, label):
+        """
+        Return the out-edge of `node` with given label, or None.
+        """
+        return self._labels.get(_node_id(node), {}).get(label)
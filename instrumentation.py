@@ -0,0 +1,196 @@
+import contextlib
+import os
+import sys
+import threading
+import time
+
+
+PROFILERS = ("cprofile", "pyinstrument")
+
+
+class _Timer:
+    __slots__ = ("_stats", "_stage", "_start")
+
+    def __init__(self, stats, stage):
+        self._stats = stats
+        self._stage = stage
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self._stats.add_time(self._stage, time.perf_counter() - self._start)
+
+
+class Instrumentation:
+    """
+    Thread-safe timers and counters of named stages.
+
+    A timer costs two `perf_counter` calls and a lock, so they are left on
+    around embedding calls, API requests and file I/O. Setting the
+    INSTRUMENTATION environment variable to 0 disables them.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.started = time.perf_counter()
+        self._timers = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.perf_counter()
+            self._timers.clear()
+            self._counters.clear()
+
+    def timer(self, stage):
+        """
+        Context manager adding the time spent in its block to `stage`.
+        """
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return _Timer(self, stage)
+
+    def add_time(self, stage, seconds):
+        with self._lock:
+            calls, total, longest = self._timers.get(stage, (0, 0.0, 0.0))
+            self._timers[stage] = (calls + 1, total + seconds, max(longest, seconds))
+
+    def count(self, name, amount=1):
+        if not self.enabled or not amount:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def snapshot(self):
+        """
+        Timers as {stage: (calls, total seconds, longest seconds)} and
+        counters as {name: count}.
+        """
+        with self._lock:
+            return dict(self._timers), dict(self._counters)
+
+    def report(self):
+        """
+        Per-stage breakdown of time since the start or last reset.
+        Nested stages are included in their parents' time, and stages run
+        on several threads may add up to more than the wall time.
+        """
+        timers, counters = self.snapshot()
+        wall = time.perf_counter() - self.started
+
+        lines = [f"Wall time: {wall:.2f}s"]
+        if timers:
+            lines.append(
+                f"{'Stage':<32} {'Calls':>8} {'Total (s)':>10} {'Mean (ms)':>10} {'Max (ms)':>10} {'Wall %':>7}"
+            )
+            for stage, (calls, total, longest) in sorted(
+                timers.items(), key=lambda item: -item[1][1]
+            ):
+                lines.append(
+                    f"{stage:<32} {calls:>8} {total:>10.3f} {total / calls * 1000:>10.3f}"
+                    f" {longest * 1000:>10.3f} {total / wall * 100:>6.1f}%"
+                )
+        for name, value in sorted(counters.items()):
+            lines.append(f"{name}: {value}")
+        return "\n".join(lines)
+
+
+# Shared by every module, so one report covers a whole run
+STATS = Instrumentation(os.environ.get("INSTRUMENTATION", "1") != "0")
+
+
+def timer(stage):
+    return STATS.timer(stage)
+
+
+def count(name, amount=1):
+    STATS.count(name, amount)
+
+
+class Progress:
+    """
+    Live throughput and ETA of a loop, printed at most every `interval`
+    seconds to `stream` (the current stderr if None), so it stays out of
+    the results on stdout. `total` may be None when it is unknown.
+    """
+
+    def __init__(self, total=None, label="Progress", interval=5.0, stream=None):
+        self.total = total
+        self.label = label
+        self.interval = interval
+        self.done = 0
+        self._stream = stream
+        self._started = time.perf_counter()
+        self._printed = self._started
+        self._lock = threading.Lock()
+
+    def update(self, amount=1):
+        with self._lock:
+            self.done += amount
+            now = time.perf_counter()
+            if now - self._printed < self.interval and self.done != self.total:
+                return
+            self._printed = now
+            line = self.status(now)
+        print(line, file=self._stream or sys.stderr, flush=True)
+
+    def status(self, now=None):
+        if now is None:
+            now = time.perf_counter()
+        elapsed = now - self._started
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+
+        if self.total is None:
+            return f"{self.label}: {self.done} ({rate:.1f}/s)"
+        eta = (self.total - self.done) / rate if rate > 0 else float("inf")
+        return f"{self.label}: {self.done} / {self.total} ({rate:.1f}/s, ETA {eta:.0f}s)"
+
+
+@contextlib.contextmanager
+def profile(profiler=None, output=None):
+    """
+    Profile the enclosed block with "cprofile" or "pyinstrument" (an
+    optional dependency), writing to `output` if it is given and printing
+    a summary otherwise. Does nothing when `profiler` is None.
+    """
+    if profiler is None:
+        yield
+        return
+
+    if profiler == "cprofile":
+        import cProfile
+        import pstats
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            if output is not None:
+                profiler.dump_stats(output)
+            else:
+                pstats.Stats(profiler).sort_stats("cumulative").print_stats(30)
+        return
+
+    if profiler == "pyinstrument":
+        from pyinstrument import Profiler
+
+        profiler = Profiler()
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            if output is not None:
+                with open(output, "w") as f:
+                    f.write(profiler.output_html())
+            else:
+                print(profiler.output_text())
+        return
+
+    raise ValueError(
+        f"Profiler should be cprofile or pyinstrument, but {profiler} is given."
+    )
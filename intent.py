@@ -1,7 +1,13 @@
-def generate_intent(graph):
-    import openai
+import re
 
-    openai_client = openai.OpenAI()
+from embedding_store import normalize_text
+
+
+def generate_intent(graph, openai_client=None):
+    if openai_client is None:
+        from api_client import create_client
+
+        openai_client = create_client()
 
     name = graph.name
 
@@ -43,20 +49,142 @@ Express your intent in Korean, in **one** sentence.
     return response_message.content
 
 
-def usage():
-    print("Usage: python intent.py <graph_filename> <out_filename> <num_samples>")
-    exit(1)
+class IntentDeduplicator:
+    """
+    Drops exact and near-duplicate intents.
+    Exact duplicates are found by their normalized text, and near duplicates
+    by Jaccard similarity of character trigrams.
+    """
+
+    def __init__(self, threshold=0.8):
+        self.threshold = threshold
+        self._seen = set()
+        self._trigrams = []
+
+    @staticmethod
+    def _key(intent):
+        return re.sub(r"[^\w]", "", normalize_text(intent).lower())
+
+    @staticmethod
+    def _trigram_set(key):
+        return {key[i : i + 3] for i in range(max(len(key) - 2, 1))}
+
+    def add(self, intent):
+        """
+        Remember the intent, returning False if it duplicates a seen one.
+        """
+        key = self._key(intent)
+        if not key or key in self._seen:
+            return False
+
+        trigrams = self._trigram_set(key)
+        for other in self._trigrams:
+            overlap = len(trigrams & other)
+            if overlap / (len(trigrams) + len(other) - overlap) >= self.threshold:
+                return False
+
+        self._seen.add(key)
+        self._trigrams.append(trigrams)
+        return True
+
+
+def generate_unique_intents(
+    graph,
+    num_samples,
+    openai_client,
+    workers=1,
+    deduplicator=None,
+    max_attempts=None,
+):
+    """
+    Generate intents on `workers` threads until `num_samples` unique ones are
+    found or `max_attempts` requests are made. Yields unique intents as they
+    arrive.
+    """
+    from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+    if deduplicator is None:
+        deduplicator = IntentDeduplicator()
+    if max_attempts is None:
+        max_attempts = num_samples * 3
+
+    accepted = 0
+    attempts = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        while True:
+            # Never request more than the unique intents still missing
+            while (
+                len(pending) < workers
+                and accepted + len(pending) < num_samples
+                and attempts < max_attempts
+            ):
+                pending.add(
+                    executor.submit(generate_intent, graph, openai_client)
+                )
+                attempts += 1
+
+            if not pending:
+                break
+
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                content = future.result()
+                if not content:
+                    print("Dropped empty response")
+                    continue
+
+                # Keep one intent per line of the output file
+                intent = " ".join(content.split())
+                if accepted >= num_samples:
+                    print(f"Dropped intent beyond the requested count: {intent}")
+                elif deduplicator.add(intent):
+                    accepted += 1
+                    yield intent
+                else:
+                    print(f"Dropped duplicate intent: {intent}")
 
 
 if __name__ == "__main__":
+    import argparse
+    import os
     import sys
 
-    if len(sys.argv) < 4:
-        usage()
+    from api_client import create_client
+    from instrumentation import STATS, Progress
+    from rate_limit import RateLimiter
+    from response_cache import MODES
+
+    parser = argparse.ArgumentParser(description="Generate intents")
+    parser.add_argument("graph_filename")
+    parser.add_argument("out_filename")
+    parser.add_argument("num_samples", type=int)
+    parser.add_argument("--workers", type=int, default=1, help="parallel requests")
+    parser.add_argument("--rpm", type=int, default=None, help="requests per minute")
+    parser.add_argument("--tpm", type=int, default=None, help="tokens per minute")
+    parser.add_argument("--base-url", default=None, help="e.g. a local stub server")
+    parser.add_argument(
+        "--cache-mode",
+        choices=MODES,
+        default=None,
+        help="response cache mode (default: $OPENAI_CACHE_MODE or passthrough)",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.8,
+        help="trigram similarity above which intents are duplicates",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="count intents already in the output file towards num_samples",
+    )
+    args = parser.parse_args()
 
-    graph_filename = sys.argv[1]
-    out_filename = sys.argv[2]
-    num_samples = int(sys.argv[3])
+    graph_filename = args.graph_filename
+    out_filename = args.out_filename
+    num_samples = args.num_samples
 
     sys.path.append("chatbot-dataset")
 
@@ -64,12 +192,37 @@ if __name__ == "__main__":
 
     chatbot_graph = parse_from_file(graph_filename)
 
+    # Intents of previous runs are never generated again
+    deduplicator = IntentDeduplicator(args.threshold)
+    existing = 0
+    if os.path.exists(out_filename):
+        with open(out_filename, "r") as f:
+            for line in f:
+                if line.strip():
+                    deduplicator.add(line.strip())
+                    existing += 1
+    if args.resume:
+        num_samples = max(num_samples - existing, 0)
+
+    openai_client = create_client(
+        args.base_url, args.cache_mode, rate_limiter=RateLimiter(args.rpm, args.tpm)
+    )
+
     # append
+    generated = 0
+    progress = Progress(num_samples, "Generated intents")
     with open(out_filename, "a") as f:
-        for i in range(num_samples):
-            print(f"Generating intent {i + 1}/{num_samples}")
-            intent = generate_intent(chatbot_graph)
+        for intent in generate_unique_intents(
+            chatbot_graph,
+            num_samples,
+            openai_client,
+            workers=args.workers,
+            deduplicator=deduplicator,
+        ):
+            generated += 1
             f.write(intent + "\n")
             f.flush()
+            progress.update()
 
-    print(f"Generated {num_samples} intents and saved to {out_filename}")
+    print(f"Generated {generated} intents and saved to {out_filename}")
+    print(STATS.report())
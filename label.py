@@ -1,3 +1,23 @@
+import json
+import random
+
+from graph_view import GraphView
+from instrumentation import timer
+
+
+# Kept byte-identical across requests so provider-side prompt caching applies
+SYSTEM_PROMPT = {
+    "role": "system",
+    "content": """
+You are a chatbot assistant.
+The user visited the website of a company "채널톡", which is a Korean IT startup.
+Your goal is to navigate the user through the chatbot by choosing the right node to follow based on the user's intent.
+Don't answer with arbitrary response; you must answer only with the nodes of the chatbot, summoning human agents, or exit.
+Try **not** to summon human agents if possible. You can exit if the user seems satisfied.
+""",
+}
+
+
 def intent_prompt_from_user(intent):
     return {"messages": [{"role": "user", "content": intent}]}
 
@@ -66,6 +86,35 @@ def prompt_from_current_node(graph, node):
     }
 
 
+def _without_summon(tools):
+    return [
+        tool for tool in tools if tool["function"]["name"] not in ("summon", "exit")
+    ]
+
+
+class PromptCache:
+    """
+    Prompt and tools of each node, built once per node and shared by all
+    conversations. The bundles must not be modified by callers.
+    """
+
+    def __init__(self, graph):
+        self._graph = graph
+        self._bundles = {}
+
+    def get(self, node):
+        bundle = self._bundles.get(node.id)
+        if bundle is None:
+            bundle = self._build(node)
+            self._bundles[node.id] = bundle
+        return bundle
+
+    def _build(self, node):
+        bundle = prompt_from_current_node(self._graph, node)
+        bundle["navigation_tools"] = _without_summon(bundle["tools"])
+        return bundle
+
+
 def ask_response(
     openai_client,
     graph,
@@ -73,109 +122,112 @@ def ask_response(
     current_node,
     tools,
     path,
-    retries=0,
+    max_retries=3,
     allow_summon=True,
 ):
-    import json
+    """
+    Ask the model to choose an edge of the current node.
 
-    if retries > 3:
-        print("ERROR: Too many retries")
-        path.append("error")
-        return None, path, messages, False
+    Invalid answers are retried up to `max_retries` times. Only the latest
+    invalid answer and its error are sent along with a retry, so requests
+    do not grow with the number of retries. Transient API errors are
+    retried, and rate limited, by the client.
+    """
+    graph = GraphView.of(graph)
 
     if not allow_summon:
-        tools = [tool for tool in tools if tool["function"]["name"] != "summon"]
-        tools = [tool for tool in tools if tool["function"]["name"] != "exit"]
-
-    # Generate response
-    response = openai_client.chat.completions.create(
-        # model="gpt-4-1106-preview",
-        model="gpt-3.5-turbo-1106",
-        messages=messages,
-        tools=tools,
-    )
-
-    # Parse response
-    response_message = response.choices[0].message
-    tool_calls = response_message.tool_calls
+        tools = _without_summon(tools)
+
+    feedback = []
+    for _ in range(max_retries + 1):
+        # Generate response
+        request_messages = messages + feedback
+        response = openai_client.chat.completions.create(
+            # model="gpt-4-1106-preview",
+            model="gpt-3.5-turbo-1106",
+            messages=request_messages,
+            tools=tools,
+        )
 
-    messages.append(response_message)
+        # Parse response
+        response_message = response.choices[0].message
+        tool_calls = response_message.tool_calls
+
+        if not tool_calls:
+            print(f"ERROR: No tool call in response, response: {response}")
+            feedback = [
+                response_message,
+                {
+                    "role": "system",
+                    "content": "ERROR: You cannot use arbitrary response.",
+                },
+            ]
+            continue
 
-    if tool_calls:
         tool_call = tool_calls[0]
         function_name = tool_call.function.name
-        function_args = json.loads(tool_call.function.arguments)
-
-        if function_name == "move_to_node":
-            print(f"- User selects {function_args['node']}")
-
-            # 6. Navigate to next node
-            edges = graph.edges_of(current_node)
-            edge = None
-            for _edge in edges:
-                if _edge.text() == function_args["node"]:
-                    edge = _edge
-                    break
-
-            if edge is None:
-                # Add error message
-                print(f"ERROR: No edge with label {function_args['node']}")
-                messages.append(
-                    {
-                        "tool_call_id": tool_call.id,
-                        "role": "tool",
-                        "name": function_name,
-                        "content": f"ERROR: No edge with label {function_args['node']}",
-                    }
-                )
-
-                return ask_response(
-                    openai_client,
-                    graph,
-                    messages,
-                    current_node,
-                    tools,
-                    path,
-                    retries + 1,
-                )
-            else:
-                current_node = graph.node(edge.to_id)
-                messages.append(
-                    {
-                        "tool_call_id": tool_call.id,
-                        "role": "tool",
-                        "name": function_name,
-                        "content": edge.text(),
-                    },
-                )
-                path.append(current_node.id)
-                return current_node, path, messages, True
+        try:
+            function_args = json.loads(tool_call.function.arguments)
+        except ValueError:
+            function_args = {}
 
-        elif function_name == "exit":
+        if function_name == "exit":
             print("- User exited the chatbot")
+            messages.append(response_message)
             path.append("exit")
             return None, path, messages, False
         elif function_name == "summon":
             print("- User summoned a human agent")
+            messages.append(response_message)
             path.append("summon")
             return None, path, messages, False
-    else:
-        print(f"ERROR: No tool call in response, response: {response}")
+
+        label = function_args.get("node") if function_name == "move_to_node" else None
+        if label is not None:
+            print(f"- User selects {label}")
+
+        # 6. Navigate to next node
+        edge = graph.edge_by_label(current_node, label)
+        if edge is None:
+            # Add error message
+            print(f"ERROR: No edge with label {label}")
+            feedback = [
+                response_message,
+                {
+                    "tool_call_id": tool_call.id,
+                    "role": "tool",
+                    "name": function_name,
+                    "content": f"ERROR: No edge with label {label}",
+                },
+            ]
+            continue
+
+        current_node = graph.node(edge.to_id)
+        messages.append(response_message)
         messages.append(
             {
-                "role": "system",
-                "content": "ERROR: You cannot use arbitrary response.",
-            }
-        )
-        return ask_response(
-            openai_client, graph, messages, current_node, tools, path, retries + 1
+                "tool_call_id": tool_call.id,
+                "role": "tool",
+                "name": function_name,
+                "content": edge.text(),
+            },
         )
+        path.append(current_node.id)
+        return current_node, path, messages, True
+
+    print("ERROR: Too many retries")
+    path.append("error")
+    return None, path, messages, False
 
 
-def run_conversation(graph, intent):
-    import openai
+def run_conversation(graph, intent, prompt_cache=None):
+    from api_client import create_client
 
-    openai_client = openai.OpenAI()
+    graph = GraphView.of(graph)
+    if prompt_cache is None:
+        prompt_cache = PromptCache(graph)
+
+    openai_client = create_client()
 
     path = []
 
@@ -186,19 +238,7 @@ def run_conversation(graph, intent):
     print("Starting conversation...")
 
     # 1. System prompt
-    system_prompt = [
-        {
-            "role": "system",
-            "content": f"""
-You are a chatbot assistant.
-The user visited the website of a company "채널톡", which is a Korean IT startup.
-Your goal is to navigate the user through the chatbot by choosing the right node to follow based on the user's intent.
-Don't answer with arbitrary response; you must answer only with the nodes of the chatbot, summoning human agents, or exit.
-Try **not** to summon human agents if possible. You can exit if the user seems satisfied.
-""",
-        }
-    ]
-    messages.extend(system_prompt)
+    messages.append(SYSTEM_PROMPT)
 
     # 2. Collect intent from user
     intent_prompt = intent_prompt_from_user(intent)
@@ -208,7 +248,7 @@ Try **not** to summon human agents if possible. You can exit if the user seems s
 
     while len(path) < 10:
         # 3. Prompt from current node
-        prompt = prompt_from_current_node(graph, current_node)
+        prompt = prompt_cache.get(current_node)
         messages.extend(prompt["messages"])
         tools = prompt["tools"]
         # TODO: might use tool_choice with node type to forbid summon() calls
@@ -234,36 +274,28 @@ Try **not** to summon human agents if possible. You can exit if the user seems s
     return path
 
 
-def run_single_prompt(graph, intent):
-    import openai
+def run_single_prompt(
+    graph, intent, openai_client=None, prompt_cache=None, rng=None
+):
+    if openai_client is None:
+        from api_client import create_client
 
-    openai_client = openai.OpenAI()
+        openai_client = create_client()
+    graph = GraphView.of(graph)
+    if prompt_cache is None:
+        prompt_cache = PromptCache(graph)
     messages = []
 
     # Choose a random starting point with more than 2 edges
-    nodes = graph.vertices()
-    nodes = [node for node in nodes if len(graph.edges_of(node)) >= 2]
-    node = random.choice(nodes)
+    node = (rng or random).choice(graph.branching_nodes)
 
     # 1. System prompt
-    system_prompt = [
-        {
-            "role": "system",
-            "content": f"""
-You are a chatbot assistant.
-The user visited the website of a company "채널톡", which is a Korean IT startup.
-Your goal is to navigate the user through the chatbot by choosing the right node to follow based on the user's intent.
-Don't answer with arbitrary response; you must answer only with the nodes of the chatbot, summoning human agents, or exit.
-Try **not** to summon human agents if possible. You can exit if the user seems satisfied.
-""",
-        }
-    ]
-    messages.extend(system_prompt)
+    messages.append(SYSTEM_PROMPT)
 
     # 2. Prompt from current node
-    prompt = prompt_from_current_node(graph, node)
+    prompt = prompt_cache.get(node)
     messages.extend(prompt["messages"])
-    tools = prompt["tools"]
+    tools = prompt["navigation_tools"]
 
     print(f"- Chatbot's prompt: {prompt['messages'][0]['content']}")
     print(f"- Choices: {[edge.text() for edge in graph.edges_of(node)]}")
@@ -288,76 +320,257 @@ Try **not** to summon human agents if possible. You can exit if the user seems s
     return path
 
 
-def usage():
-    print(
-        "Usage: python3 evalute.py <chatbot-filename> <intent-filename> <num-conversations> <out-filename>"
-    )
-    exit(1)
+def label_row(graph, intent, path):
+    """
+    Labeled data of a single prompt, in the format `evaluate.py` reads.
+    Returns None if the conversation ended without choosing an edge.
+    """
+    [start, choice] = path
+    edges = graph.edges_of(start)
+
+    prompt = graph.node(start).text()
+    choices = [{"text": edge.text(), "nextSectionId": edge.to_id} for edge in edges]
+    choices_map = {
+        edge.to_id: {"text": edge.text(), "nextSectionId": edge.to_id}
+        for edge in edges
+    }
+    if choice not in choices_map:
+        return None
+
+    return {
+        "intent": intent,
+        "prompt": prompt,
+        "choices": choices,
+        "choice": choices_map[choice],
+    }
+
+
+def _is_fatal(error):
+    """
+    Whether an API error would fail every other conversation too, e.g. an
+    invalid API key or model name.
+    """
+    return getattr(error, "status_code", None) in (401, 403, 404)
+
+
+def run_prompts(graph, intents, openai_client, workers=1, seed=None):
+    """
+    Run single prompts for given intents on `workers` threads.
+    Yields labeled rows as soon as each conversation finishes. A failed
+    conversation is reported and skipped, so `--resume` retries it later;
+    fatal API errors stop the run and cancel queued conversations.
+    With a `seed`, the start node of each intent is chosen reproducibly,
+    so recorded responses can be replayed.
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    graph = GraphView.of(graph)
+    prompt_cache = PromptCache(graph)
+
+    def run(intent):
+        rng = None if seed is None else random.Random(f"{seed}:{intent}")
+        with timer("conversation"):
+            path = run_single_prompt(graph, intent, openai_client, prompt_cache, rng)
+        return label_row(graph, intent, path)
+
+    if workers <= 1:
+        for intent in intents:
+            try:
+                row = run(intent)
+            except Exception as error:
+                if _is_fatal(error):
+                    raise
+                print(f"ERROR: Conversation failed for intent {intent}: {error}")
+                continue
+            yield row
+        return
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        futures = {executor.submit(run, intent): intent for intent in intents}
+        for future in as_completed(futures):
+            try:
+                row = future.result()
+            except Exception as error:
+                if _is_fatal(error):
+                    raise
+                print(f"ERROR: Conversation failed for intent {futures[future]}: {error}")
+                continue
+            yield row
+    except BaseException:
+        # Don't pay for queued conversations whose rows would be thrown away
+        executor.shutdown(cancel_futures=True)
+        raise
+    executor.shutdown()
+
+
+def read_log(log_filename):
+    """
+    Stream labeled rows from a log file, skipping a partially written last line.
+    """
+    import os
+
+    if not os.path.exists(log_filename):
+        return
+
+    with open(log_filename, "r") as f:
+        for line in f:
+            if not line.endswith("\n"):
+                break
+            if line.strip():
+                yield json.loads(line)
+
+
+def truncate_partial_line(log_filename):
+    """
+    Drop a partially written last line left by a crash, so appended rows
+    start on their own line.
+    """
+    import os
+
+    if not os.path.exists(log_filename):
+        return
+
+    with open(log_filename, "rb+") as f:
+        data_end = f.seek(0, os.SEEK_END)
+        position = data_end
+        while position > 0:
+            f.seek(position - 1)
+            if f.read(1) == b"\n":
+                break
+            position -= 1
+        if position != data_end:
+            f.truncate(position)
+
+
+def write_json_from_log(log_filename, json_filename):
+    """
+    Write rows of a log file as a JSON array without loading all of them.
+    Returns the number of rows.
+    """
+    import textwrap
+
+    count = 0
+    with open(json_filename, "w") as f:
+        f.write("[")
+        for row in read_log(log_filename):
+            f.write(",\n" if count > 0 else "\n")
+            f.write(textwrap.indent(json.dumps(row, ensure_ascii=False, indent=2), "  "))
+            count += 1
+        f.write("\n]" if count > 0 else "]")
+    return count
+
+
+def run_seed(meta_filename, seed=None, resume=False):
+    """
+    Seed of the intent shuffle order, recorded next to the output so that
+    resumed runs process intents in the same order.
+    """
+    import os
+
+    if resume and os.path.exists(meta_filename):
+        with open(meta_filename, "r") as f:
+            return json.load(f)["seed"]
+
+    if seed is None:
+        seed = random.randrange(2**32)
+    with open(meta_filename, "w") as f:
+        json.dump({"seed": seed}, f)
+    return seed
 
 
 if __name__ == "__main__":
-    import json
-    import random
+    import argparse
     import sys
 
-    if len(sys.argv) != 5:
-        usage()
+    from api_client import create_client
+    from instrumentation import PROFILERS, STATS, Progress, profile
+    from rate_limit import RateLimiter
+    from response_cache import MODES
+
+    parser = argparse.ArgumentParser(description="Simulate conversations")
+    parser.add_argument("chatbot_filename")
+    parser.add_argument("intent_filename")
+    parser.add_argument("num_conversations", type=int)
+    parser.add_argument("out_filename")
+    parser.add_argument("--workers", type=int, default=1, help="parallel requests")
+    parser.add_argument("--rpm", type=int, default=None, help="requests per minute")
+    parser.add_argument("--tpm", type=int, default=None, help="tokens per minute")
+    parser.add_argument("--base-url", default=None, help="e.g. a local stub server")
+    parser.add_argument(
+        "--cache-mode",
+        choices=MODES,
+        default=None,
+        help="response cache mode (default: $OPENAI_CACHE_MODE or passthrough)",
+    )
+    parser.add_argument("--seed", type=int, default=None, help="intent shuffle seed")
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="reuse the recorded seed and skip intents already in the log",
+    )
+    parser.add_argument("--profile", choices=PROFILERS, default=None)
+    parser.add_argument(
+        "--profile-output", default=None, help="file to write the profile to"
+    )
+    args = parser.parse_args()
 
-    chatbot_filename = sys.argv[1]
-    intent_filename = sys.argv[2]
-    num_conversations = int(sys.argv[3])
-    out_filename = sys.argv[4]
+    chatbot_filename = args.chatbot_filename
+    intent_filename = args.intent_filename
+    num_conversations = args.num_conversations
+    out_filename = args.out_filename
 
     # Save log to a separate file to avoid losing progress when the program crashes
     out_filename_log = out_filename + ".log"
     out_filename_json = out_filename + ".json"
+    out_filename_meta = out_filename + ".meta.json"
 
     sys.path.append("chatbot-dataset")
 
     from chatbot import parse_from_file
 
-    chatbot_graph = parse_from_file(chatbot_filename)
-
-    with open(out_filename_log, "a") as out:
-        with open(intent_filename, "r") as f:
-            intents = f.readlines()
-            random.shuffle(intents)
-            for i in range(num_conversations):
-                intent = intents[i].strip()
-                [start, choice] = run_single_prompt(chatbot_graph, intent)
-
-                # Write result to log file
-                prompt = chatbot_graph.node(start).text()
-                choices = [
-                    {"text": edge.text(), "nextSectionId": edge.to_id}
-                    for edge in chatbot_graph.edges_of(start)
-                ]
-                choices_map = {
-                    edge.to_id: {"text": edge.text(), "nextSectionId": edge.to_id}
-                    for edge in chatbot_graph.edges_of(start)
-                }
-
-                log = json.dumps(
-                    {
-                        "intent": intent,
-                        "prompt": prompt,
-                        "choices": choices,
-                        "choice": choices_map[choice],
-                    },
-                    ensure_ascii=False,
-                )
-                out.write(f"{log}\n")
-                out.flush()
+    chatbot_graph = GraphView(parse_from_file(chatbot_filename))
 
-    # Write result to output file
-    out_json = []
-    with open(out_filename_log, "r") as f:
-        for line in f.readlines():
-            out_json.append(json.loads(line.strip()))
+    openai_client = create_client(
+        args.base_url, args.cache_mode, rate_limiter=RateLimiter(args.rpm, args.tpm)
+    )
 
-    with open(out_filename_json, "w") as f:
-        json.dump(out_json, f, ensure_ascii=False, indent=2)
+    seed = run_seed(out_filename_meta, args.seed, args.resume)
+    print(f"Shuffling intents with seed {seed}")
+
+    with open(intent_filename, "r") as f:
+        intents = f.readlines()
+        random.Random(seed).shuffle(intents)
+        intents = [intent.strip() for intent in intents[:num_conversations]]
+
+    if args.resume:
+        labeled = {row["intent"] for row in read_log(out_filename_log)}
+        intents = [intent for intent in intents if intent not in labeled]
+        print(f"Resuming: {len(intents)} of {num_conversations} intents left")
+
+    truncate_partial_line(out_filename_log)
+    progress = Progress(len(intents), "Conversations")
+    with profile(args.profile, args.profile_output), open(out_filename_log, "a") as out:
+        for row in run_prompts(
+            chatbot_graph,
+            intents,
+            openai_client,
+            args.workers,
+            seed,
+        ):
+            progress.update()
+            if row is None:
+                continue
+
+            # Write each row as soon as it finishes
+            log = json.dumps(row, ensure_ascii=False)
+            out.write(f"{log}\n")
+            out.flush()
+
+    # Write result to output file
+    num_rows = write_json_from_log(out_filename_log, out_filename_json)
 
     print(
-        f"Saved result to {out_filename_json}, {out_filename_log}. Generated {len(out_json)} conversations."
+        f"Saved result to {out_filename_json}, {out_filename_log}. Generated {num_rows} conversations."
     )
+    print(STATS.report())
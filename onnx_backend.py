@@ -0,0 +1,255 @@
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from embedding_store import _directory_name
+
+
+DEFAULT_EXPORT_PATH = os.environ.get("ONNX_EXPORT_PATH", ".onnx_models")
+
+# Pooling modes reproduced on the ONNX outputs
+POOLING_MODES = ("cls", "max", "mean")
+
+
+def export_model(model_name, directory):
+    """
+    Export the transformer of a SentenceTransformer model to ONNX, together
+    with its tokenizer and pooling configuration, and an int8 dynamically
+    quantized copy.
+
+    Files are written to a temporary directory next to `directory` and moved
+    into place once complete, so an interrupted export is never trusted.
+    """
+    from sentence_transformers import SentenceTransformer
+
+    model = SentenceTransformer(model_name, device="cpu")
+    modules = [type(module).__name__ for module in model]
+    # Other modules, such as Dense, would be silently skipped
+    if modules[:2] != ["Transformer", "Pooling"] or any(
+        module != "Normalize" for module in modules[2:]
+    ):
+        raise ValueError(
+            "ONNX export supports Transformer, Pooling and optional Normalize "
+            f"modules, but {model_name} has {', '.join(modules)}."
+        )
+    pooling_mode = model[1].get_pooling_mode_str()
+    if pooling_mode not in POOLING_MODES:
+        raise ValueError(
+            f"Pooling should be one of {POOLING_MODES}, but {pooling_mode} is given."
+        )
+
+    parent = os.path.dirname(os.path.abspath(directory))
+    os.makedirs(parent, exist_ok=True)
+    temporary = tempfile.mkdtemp(dir=parent)
+    try:
+        _export(model, pooling_mode, len(modules) > 2, temporary)
+        if os.path.exists(os.path.join(directory, "model.int8.onnx")):
+            # Exported by another process in the meantime
+            return
+        if os.path.exists(directory):
+            # Left by an interrupted export of an older version
+            shutil.rmtree(directory)
+        os.replace(temporary, directory)
+    finally:
+        if os.path.exists(temporary):
+            shutil.rmtree(temporary)
+
+
+def _export(model, pooling_mode, normalize, directory):
+    import torch
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    transformer = model[0]
+    transformer.tokenizer.save_pretrained(directory)
+
+    with open(os.path.join(directory, "pooling.json"), "w") as f:
+        json.dump(
+            {
+                "pooling": pooling_mode,
+                "normalize": normalize,
+                "max_length": transformer.max_seq_length,
+            },
+            f,
+        )
+
+    dummy = transformer.tokenizer(["임베딩 모델을 변환합니다."], return_tensors="pt")
+    input_names = [
+        name
+        for name in ("input_ids", "attention_mask", "token_type_ids")
+        if name in dummy
+    ]
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+    dynamic_axes["last_hidden_state"] = {0: "batch", 1: "sequence"}
+
+    fp32_path = os.path.join(directory, "model.onnx")
+    transformer.auto_model.eval()
+    with torch.no_grad():
+        torch.onnx.export(
+            transformer.auto_model,
+            tuple(dummy[name] for name in input_names),
+            fp32_path,
+            input_names=input_names,
+            output_names=["last_hidden_state"],
+            dynamic_axes=dynamic_axes,
+            opset_version=14,
+        )
+
+    quantize_dynamic(
+        fp32_path,
+        os.path.join(directory, "model.int8.onnx"),
+        weight_type=QuantType.QInt8,
+    )
+
+
+def exported_model(model_name, export_path=DEFAULT_EXPORT_PATH):
+    """
+    Directory of the ONNX export of `model_name`, exported on first use.
+    """
+    directory = os.path.join(export_path, _directory_name(model_name))
+    if not os.path.exists(os.path.join(directory, "model.int8.onnx")):
+        export_model(model_name, directory)
+    return directory
+
+
+class OnnxSentenceEncoder:
+    """
+    CPU inference of a SentenceTransformer model through ONNX Runtime.
+
+    The model is exported once under `export_path`. Sentences are sorted by
+    length and encoded in batches of `batch_size`, padded only to the longest
+    sentence of each batch.
+    """
+
+    def __init__(
+        self,
+        model_name,
+        quantize=True,
+        num_threads=None,
+        batch_size=32,
+        export_path=DEFAULT_EXPORT_PATH,
+    ):
+        import onnxruntime
+        from transformers import AutoTokenizer
+
+        directory = exported_model(model_name, export_path)
+
+        with open(os.path.join(directory, "pooling.json"), "r") as f:
+            config = json.load(f)
+        if config["pooling"] not in POOLING_MODES:
+            # Exported before unsupported modes were rejected
+            raise ValueError(
+                f"Pooling should be one of {POOLING_MODES}, but {config['pooling']} is given."
+            )
+        self._pooling = config["pooling"]
+        self._normalize = config["normalize"]
+        self._max_length = config["max_length"]
+
+        self.variant = "onnx-int8" if quantize else "onnx"
+        self.batch_size = batch_size
+
+        options = onnxruntime.SessionOptions()
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+            options.inter_op_num_threads = 1
+        self._session = onnxruntime.InferenceSession(
+            os.path.join(directory, "model.int8.onnx" if quantize else "model.onnx"),
+            options,
+            providers=["CPUExecutionProvider"],
+        )
+        self._input_names = [item.name for item in self._session.get_inputs()]
+        self._tokenizer = AutoTokenizer.from_pretrained(directory)
+
+    def _pool(self, hidden, mask):
+        if self._pooling == "cls":
+            return hidden[:, 0]
+        if self._pooling == "max":
+            return np.where(mask[:, :, None], hidden, -np.inf).max(axis=1)
+        mask = mask[:, :, None].astype(hidden.dtype)
+        return (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+
+    def encode(self, sentences):
+        """
+        Return embeddings of given sentences as a float32 2D array.
+        """
+        if isinstance(sentences, str):
+            return self.encode([sentences])[0]
+
+        order = sorted(range(len(sentences)), key=lambda i: len(sentences[i]))
+        embeddings = [None] * len(sentences)
+
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start : start + self.batch_size]
+            inputs = self._tokenizer(
+                [sentences[i] for i in batch],
+                padding=True,
+                truncation=True,
+                max_length=self._max_length,
+                return_tensors="np",
+            )
+            feed = {name: inputs[name].astype(np.int64) for name in self._input_names}
+            hidden = self._session.run(["last_hidden_state"], feed)[0]
+            pooled = self._pool(hidden, inputs["attention_mask"])
+            for i, embedding in zip(batch, pooled):
+                embeddings[i] = embedding
+
+        embeddings = np.array(embeddings, dtype=np.float32).reshape(len(sentences), -1)
+        if self._normalize:
+            embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings
+
+
+def parity_check(model_name, sentences, **options):
+    """
+    Compare ONNX embeddings to the PyTorch ones of the same model.
+    Returns cosine similarities of each sentence's two embeddings, and the
+    throughput of both backends in sentences per second.
+    """
+    import time
+
+    from sentence_transformers import SentenceTransformer
+
+    reference_model = SentenceTransformer(model_name, device="cpu")
+    encoder = OnnxSentenceEncoder(model_name, **options)
+
+    start = time.perf_counter()
+    reference = reference_model.encode(sentences, batch_size=encoder.batch_size)
+    reference_throughput = len(sentences) / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    embeddings = encoder.encode(sentences)
+    throughput = len(sentences) / (time.perf_counter() - start)
+
+    cosine = np.sum(reference * embeddings, axis=1) / (
+        np.linalg.norm(reference, axis=1) * np.linalg.norm(embeddings, axis=1)
+    )
+    return cosine, reference_throughput, throughput
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Check ONNX backend parity")
+    parser.add_argument("sentence_filename", help="one sentence per line")
+    parser.add_argument("--model", default="jhgan/ko-sroberta-multitask")
+    parser.add_argument("--no-quantize", action="store_true")
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=32)
+    args = parser.parse_args()
+
+    with open(args.sentence_filename, "r") as f:
+        sentences = [line.strip() for line in f if line.strip()]
+
+    cosine, reference_throughput, throughput = parity_check(
+        args.model,
+        sentences,
+        quantize=not args.no_quantize,
+        num_threads=args.threads,
+        batch_size=args.batch_size,
+    )
+
+    print(f"Cosine similarity to PyTorch: min {cosine.min():.5f}, mean {cosine.mean():.5f}")
+    print(f"PyTorch throughput: {reference_throughput:.1f} sentences/s")
+    print(f"ONNX throughput: {throughput:.1f} sentences/s")
@@ -0,0 +1,79 @@
+def graph_texts(graph):
+    """
+    Node texts and edge labels of a chatbot graph.
+    """
+    for node in graph.vertices():
+        yield node.text()
+        for edge in graph.edges_of(node):
+            yield edge.text()
+
+
+def intent_texts(filename):
+    """
+    Intents of a file written by intent.py, one per line.
+    """
+    with open(filename, "r") as f:
+        for line in f:
+            if line.strip():
+                yield line.strip()
+
+
+def label_texts(filename):
+    """
+    Intents and choices of labeled data written by label.py.
+    """
+    from evaluate import iter_label_data
+
+    for item in iter_label_data(filename):
+        yield item.intent
+        yield from item.choices
+
+
+if __name__ == "__main__":
+    import argparse
+    import itertools
+    import sys
+
+    from embedding_artifact import write_artifact
+    from embedding_codec import EmbeddingCodec
+    from evaluate import EVALUATORS, EmbeddingEvaluator
+
+    parser = argparse.ArgumentParser(description="Precompute embeddings")
+    parser.add_argument("chatbot_filename")
+    parser.add_argument("out_dirname")
+    parser.add_argument("--intents", action="append", default=[], help="intent file")
+    parser.add_argument("--labels", action="append", default=[], help="label file")
+    parser.add_argument("--evaluator", choices=EVALUATORS, default="sentence_bert")
+    parser.add_argument(
+        "--codec",
+        type=EmbeddingCodec.parse,
+        default="float32",
+        help="storage such as float16, int8, int8+truncate:512 or int8+pca:256",
+    )
+    parser.add_argument("--batch-size", type=int, default=512)
+    args = parser.parse_args()
+
+    evaluator = EVALUATORS[args.evaluator]()
+    if not isinstance(evaluator, EmbeddingEvaluator):
+        print(f"Evaluator {args.evaluator} has no embeddings")
+        exit(1)
+
+    sys.path.append("chatbot-dataset")
+
+    from chatbot import parse_from_file
+
+    texts = itertools.chain(
+        graph_texts(parse_from_file(args.chatbot_filename)),
+        *[intent_texts(filename) for filename in args.intents],
+        *[label_texts(filename) for filename in args.labels],
+    )
+
+    num_rows = write_artifact(
+        args.out_dirname,
+        evaluator.model_name,
+        texts,
+        evaluator.embeddings,
+        args.codec,
+        args.batch_size,
+    )
+    print(f"Saved {num_rows} embeddings of {evaluator.model_name} to {args.out_dirname}")
@@ -0,0 +1,82 @@
+import json
+import threading
+import time
+
+from instrumentation import timer
+
+
+class _Bucket:
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.available = per_minute
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.available = min(
+            self.capacity, self.available + (now - self.updated) * self.rate
+        )
+        self.updated = now
+
+    def wait_time(self, amount):
+        # Requests larger than the bucket only wait for a full bucket
+        amount = min(amount, self.capacity)
+        if self.available >= amount:
+            return 0
+        return (amount - self.available) / self.rate
+
+
+class RateLimiter:
+    """
+    Thread-safe token bucket limiting requests and tokens per minute.
+    A limit of None disables it.
+    """
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self._buckets = []
+        self._requests = None
+        self._tokens = None
+        if requests_per_minute:
+            self._requests = _Bucket(requests_per_minute)
+            self._buckets.append(self._requests)
+        if tokens_per_minute:
+            self._tokens = _Bucket(tokens_per_minute)
+            self._buckets.append(self._tokens)
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=0):
+        """
+        Block until a request using `tokens` tokens is allowed.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                for bucket in self._buckets:
+                    bucket.refill(now)
+
+                wait = 0
+                if self._requests is not None:
+                    wait = max(wait, self._requests.wait_time(1))
+                if self._tokens is not None:
+                    wait = max(wait, self._tokens.wait_time(tokens))
+
+                if wait == 0:
+                    if self._requests is not None:
+                        self._requests.available -= 1
+                    if self._tokens is not None:
+                        self._tokens.available -= tokens
+                    return
+
+            with timer("rate_limit.wait"):
+                time.sleep(wait)
+
+
+def estimate_tokens(*payloads):
+    """
+    Rough token count of request payloads, for rate limiting only.
+    Korean text is close to one token per character, so be conservative.
+    """
+    return sum(
+        len(json.dumps(payload, ensure_ascii=False, default=str)) // 2
+        for payload in payloads
+    )
@@ -0,0 +1,158 @@
+import os
+from types import SimpleNamespace
+
+from instrumentation import count
+from sqlite_cache import SQLiteCache, fingerprint
+
+
+DEFAULT_CACHE_PATH = os.environ.get("OPENAI_CACHE_PATH", ".openai_cache.sqlite")
+
+MODES = ("passthrough", "record", "replay")
+
+
+class ResponseCacheMiss(KeyError):
+    """
+    Raised in replay mode when a request was never recorded.
+    """
+
+
+def _jsonable(value):
+    """
+    Plain JSON data of a request, including messages given as response objects.
+    """
+    if hasattr(value, "model_dump"):
+        return value.model_dump(mode="json", exclude_none=True)
+    if isinstance(value, dict):
+        return {key: _jsonable(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(item) for item in value]
+    return value
+
+
+def request_key(endpoint, request):
+    """
+    Content address of a request.
+    """
+    return fingerprint([endpoint, _jsonable(request)])
+
+
+class ResponseCache(SQLiteCache):
+    """
+    Request to response cache in a SQLite file.
+
+    Identical requests are numbered by occurrence within a process, so
+    repeated sampling requests (e.g. intent generation) replay distinct
+    recorded responses in turn.
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS responses (
+            key TEXT NOT NULL,
+            occurrence INTEGER NOT NULL,
+            endpoint TEXT NOT NULL,
+            response TEXT NOT NULL,
+            PRIMARY KEY (key, occurrence)
+        )
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH):
+        super().__init__(path)
+        self._occurrences = {}
+
+    def next_occurrence(self, key):
+        with self._lock:
+            occurrence = self._occurrences.get(key, 0)
+            self._occurrences[key] = occurrence + 1
+            return occurrence
+
+    def get(self, key, occurrence):
+        """
+        Return recorded response JSON, or None if it is not recorded.
+        """
+        with self._lock:
+            row = (
+                self._connect()
+                .execute(
+                    "SELECT response FROM responses WHERE key = ? AND occurrence = ?",
+                    (key, occurrence),
+                )
+                .fetchone()
+            )
+        return None if row is None else row[0]
+
+    def put(self, key, occurrence, endpoint, response):
+        with self._lock:
+            connection = self._connect()
+            connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                (key, occurrence, endpoint, response),
+            )
+            connection.commit()
+
+
+class _CachedEndpoint:
+    def __init__(self, name, create, response_type, cache, mode):
+        self._name = name
+        self._create = create
+        self._response_type = response_type
+        self._cache = cache
+        self._mode = mode
+
+    def create(self, **request):
+        if self._mode == "passthrough":
+            return self._create(**request)
+
+        key = request_key(self._name, request)
+        occurrence = self._cache.next_occurrence(key)
+
+        recorded = self._cache.get(key, occurrence)
+        if recorded is not None:
+            count("response_cache.hit")
+            return self._response_type().model_validate_json(recorded)
+
+        count("response_cache.miss")
+        if self._mode == "replay":
+            raise ResponseCacheMiss(f"No recorded response for {self._name} request")
+
+        response = self._create(**request)
+        self._cache.put(key, occurrence, self._name, response.model_dump_json())
+        return response
+
+
+def _chat_completion_type():
+    from openai.types.chat import ChatCompletion
+
+    return ChatCompletion
+
+
+def _embedding_response_type():
+    from openai.types import CreateEmbeddingResponse
+
+    return CreateEmbeddingResponse
+
+
+class CachedClient:
+    """
+    OpenAI client wrapper serving `chat.completions.create` and
+    `embeddings.create` through a response cache.
+
+    - passthrough: always call the API.
+    - record: return recorded responses, calling and recording the rest.
+    - replay: only return recorded responses, never touching the network.
+    """
+
+    def __init__(self, client, cache, mode="record"):
+        if mode not in MODES:
+            raise ValueError(f"Cache mode should be one of {MODES}, but {mode} is given.")
+
+        def endpoint(name, resource, response_type):
+            create = None if client is None else resource(client).create
+            return _CachedEndpoint(name, create, response_type, cache, mode)
+
+        self.chat = SimpleNamespace()
+        self.chat.completions = endpoint(
+            "chat.completions", lambda c: c.chat.completions, _chat_completion_type
+        )
+        self.embeddings = endpoint(
+            "embeddings", lambda c: c.embeddings, _embedding_response_type
+        )
@@ -0,0 +1,147 @@
+import email.utils
+import random
+import time
+from types import SimpleNamespace
+
+from instrumentation import count, timer
+from rate_limit import estimate_tokens
+
+
+# Retries allowed for each class of transient error
+DEFAULT_LIMITS = {
+    "rate_limit": 8,
+    "server": 5,
+    "timeout": 4,
+    "connection": 4,
+}
+
+
+def classify_error(error):
+    """
+    Class of a transient API error, or None if retrying would not help.
+    """
+    status = getattr(error, "status_code", None)
+    if status == 429:
+        return "rate_limit"
+    if status == 408:
+        return "timeout"
+    if status == 409:
+        # Conflicts with a concurrent request on the server's side
+        return "server"
+    if status is not None and status >= 500:
+        return "server"
+
+    name = type(error).__name__
+    if isinstance(error, TimeoutError) or "Timeout" in name:
+        return "timeout"
+    if isinstance(error, ConnectionError) or "Connection" in name:
+        return "connection"
+    return None
+
+
+def retry_after(error):
+    """
+    Delay in seconds requested by the server's Retry-After headers, if any.
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+
+    value = headers.get("retry-after-ms")
+    if value is not None:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(date.timestamp() - time.time(), 0)
+
+
+class RetryPolicy:
+    """
+    Retries transient API errors with exponential backoff and full jitter,
+    honoring Retry-After and a separate retry limit per error class.
+    """
+
+    def __init__(self, base_delay=1.0, max_delay=60.0, limits=None, sleep=time.sleep):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.limits = dict(DEFAULT_LIMITS if limits is None else limits)
+        self._sleep = sleep
+
+    def delay(self, retry, error):
+        requested = retry_after(error)
+        if requested is not None:
+            return min(requested, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**retry))
+
+    def call(self, function, *args, **kwargs):
+        retries = {}
+        while True:
+            try:
+                return function(*args, **kwargs)
+            except Exception as error:
+                error_class = classify_error(error)
+                if error_class is None:
+                    raise
+
+                retry = retries.get(error_class, 0)
+                if retry >= self.limits.get(error_class, 0):
+                    raise
+                retries[error_class] = retry + 1
+                count(f"api.retry.{error_class}")
+
+                delay = self.delay(retry, error)
+                print(f"Retrying after {error_class} error in {delay:.1f}s: {error}")
+                with timer("api.backoff"):
+                    self._sleep(delay)
+
+
+class _RetryingEndpoint:
+    def __init__(self, name, create, policy, rate_limiter=None):
+        self._name = name
+        self._create = create
+        self._policy = policy
+        self._rate_limiter = rate_limiter
+
+    def _attempt(self, **request):
+        # Every attempt is a request, so retries count towards the limits too
+        if self._rate_limiter is not None:
+            self._rate_limiter.acquire(estimate_tokens(request))
+        with timer(f"api.{self._name}"):
+            return self._create(**request)
+
+    def create(self, **request):
+        return self._policy.call(self._attempt, **request)
+
+
+class RetryingClient:
+    """
+    OpenAI client wrapper retrying `chat.completions.create` and
+    `embeddings.create` with a retry policy, acquiring `rate_limiter` (a
+    `RateLimiter`) before each attempt if it is given.
+    """
+
+    def __init__(self, client, policy=None, rate_limiter=None):
+        if policy is None:
+            policy = RetryPolicy()
+
+        self.chat = SimpleNamespace()
+        self.chat.completions = _RetryingEndpoint(
+            "chat.completions", client.chat.completions.create, policy, rate_limiter
+        )
+        self.embeddings = _RetryingEndpoint(
+            "embeddings", client.embeddings.create, policy, rate_limiter
+        )
@@ -0,0 +1,208 @@
+import numpy as np
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, np.finfo(np.float32).tiny)
+
+
+def _top_k(scores, k):
+    """
+    Positions of the k largest scores, in descending order of score.
+    """
+    k = min(k, len(scores))
+    if k == 0:
+        return np.empty(0, dtype=np.int64)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top], kind="stable")]
+
+
+class BruteForceIndex:
+    """
+    Exact cosine similarity search over all vectors.
+    """
+
+    def __init__(self, vectors):
+        self._vectors = _normalize(vectors)
+
+    def __len__(self):
+        return len(self._vectors)
+
+    def search(self, query, k, candidates=None):
+        """
+        Return rows and scores of the k vectors most similar to `query`,
+        optionally among the given candidate rows only.
+        """
+        query = _normalize(query)
+        if candidates is None:
+            scores = self._vectors @ query
+            top = _top_k(scores, k)
+            return top, scores[top]
+
+        candidates = np.asarray(candidates, dtype=np.int64)
+        scores = self._vectors[candidates] @ query
+        top = _top_k(scores, k)
+        return candidates[top], scores[top]
+
+
+class IVFIndex(BruteForceIndex):
+    """
+    Approximate search with an inverted file: vectors are clustered with
+    k-means, and only the `num_probes` clusters closest to the query are
+    scanned. Searches restricted to candidate rows are exact.
+    """
+
+    def __init__(self, vectors, num_lists=None, num_probes=4, iterations=10, seed=0):
+        super().__init__(vectors)
+        if num_lists is None:
+            num_lists = max(1, int(np.sqrt(len(self._vectors))))
+        self.num_probes = num_probes
+
+        self._centroids, assignment = self._kmeans(num_lists, iterations, seed)
+        order = np.argsort(assignment, kind="stable")
+        bounds = np.searchsorted(assignment[order], np.arange(len(self._centroids) + 1))
+        self._lists = [order[bounds[i] : bounds[i + 1]] for i in range(len(bounds) - 1)]
+
+    def _kmeans(self, num_lists, iterations, seed):
+        rng = np.random.default_rng(seed)
+        num_lists = min(num_lists, len(self._vectors))
+        centroids = self._vectors[
+            rng.choice(len(self._vectors), num_lists, replace=False)
+        ]
+        for _ in range(iterations):
+            assignment = np.argmax(self._vectors @ centroids.T, axis=1)
+            for i in range(num_lists):
+                members = self._vectors[assignment == i]
+                if len(members) > 0:
+                    centroids[i] = members.mean(axis=0)
+            centroids = _normalize(centroids)
+        assignment = np.argmax(self._vectors @ centroids.T, axis=1)
+        return centroids, assignment
+
+    def search(self, query, k, candidates=None):
+        if candidates is not None:
+            return super().search(query, k, candidates)
+
+        query = _normalize(query)
+        probes = _top_k(self._centroids @ query, self.num_probes)
+        candidates = np.concatenate([self._lists[i] for i in probes])
+        return super().search(query, k, candidates)
+
+
+class RoutingIndex:
+    """
+    Pre-embedded edge labels and node texts of a chatbot graph, answering
+    which nodes an utterance most likely leads to.
+
+    `embedder` is anything with an `embeddings(sentences)` method, such as
+    `BertEmbedding`, `OpenAIEmbedding` or an embedding evaluator.
+    """
+
+    BACKENDS = {"exact": BruteForceIndex, "ivf": IVFIndex}
+
+    def __init__(self, graph, embedder, backend="exact", **backend_options):
+        self._embedder = embedder
+
+        # Each entry leads to a node: an edge label leads to the edge's
+        # target, and a node text leads to the node itself.
+        self.texts = []
+        self.targets = []
+        out_edges = {}
+        for node in graph.vertices():
+            rows = out_edges.setdefault(node.id, [])
+            for edge in graph.edges_of(node):
+                if edge.text():
+                    rows.append(len(self.texts))
+                    self.texts.append(edge.text())
+                    self.targets.append(edge.to_id)
+            if node.text():
+                self.texts.append(node.text())
+                self.targets.append(node.id)
+
+        self._out_edges = {
+            node_id: np.array(rows, dtype=np.int64)
+            for node_id, rows in out_edges.items()
+        }
+
+        unique_texts = list(dict.fromkeys(self.texts))
+        vectors = np.asarray(embedder.embeddings(unique_texts), dtype=np.float32)
+        rows = {text: i for i, text in enumerate(unique_texts)}
+        vectors = vectors[[rows[text] for text in self.texts]]
+
+        self._index = self.BACKENDS[backend](vectors, **backend_options)
+
+    def route_vector(self, query, k=3, node_id=None):
+        """
+        Top-k next nodes for an embedded utterance as (node id, score, text),
+        restricted to the out-edges of `node_id` if it is given.
+        """
+        candidates = None
+        if node_id is not None:
+            candidates = self._out_edges.get(node_id, np.empty(0, dtype=np.int64))
+
+        # Several entries may lead to the same node, so search a little wider
+        rows, scores = self._index.search(query, k * 4, candidates)
+
+        routes = []
+        seen = set()
+        for row, score in zip(rows, scores):
+            target = self.targets[row]
+            if target in seen:
+                continue
+            seen.add(target)
+            routes.append((target, float(score), self.texts[row]))
+            if len(routes) == k:
+                break
+        return routes
+
+    def route(self, utterance, k=3, node_id=None):
+        """
+        Top-k next nodes for an utterance as (node id, score, text).
+        """
+        query = np.asarray(self._embedder.embeddings([utterance])[0])
+        return self.route_vector(query, k, node_id)
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+    import time
+
+    parser = argparse.ArgumentParser(description="Route utterances in a chatbot")
+    parser.add_argument("chatbot_filename")
+    parser.add_argument("--model", default="jhgan/ko-sroberta-multitask")
+    parser.add_argument("--openai", action="store_true", help="use OpenAI embeddings")
+    parser.add_argument("--backend", choices=RoutingIndex.BACKENDS, default="exact")
+    parser.add_argument("--node", default=None, help="current node id")
+    parser.add_argument("-k", type=int, default=3)
+    args = parser.parse_args()
+
+    sys.path.append("chatbot-dataset")
+
+    from chatbot import parse_from_file
+
+    if args.openai:
+        from sentence_similarity_openai import OpenAIEmbedding
+
+        embedder = OpenAIEmbedding(args.model)
+    else:
+        from sentence_similarity_bert import BertEmbedding
+
+        embedder = BertEmbedding(args.model)
+
+    index = RoutingIndex(parse_from_file(args.chatbot_filename), embedder, args.backend)
+
+    for line in sys.stdin:
+        utterance = line.strip()
+        if not utterance:
+            continue
+        query = np.asarray(embedder.embeddings([utterance])[0])
+
+        start = time.perf_counter()
+        routes = index.route_vector(query, args.k, args.node)
+        elapsed = time.perf_counter() - start
+
+        for node_id, score, text in routes:
+            print(f"{score:.3f}\t{node_id}\t{text}")
+        print(f"({elapsed * 1000:.3f} ms)")
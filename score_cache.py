@@ -0,0 +1,68 @@
+import os
+
+from sqlite_cache import SQLiteCache, fingerprint
+
+
+DEFAULT_SCORE_CACHE_PATH = os.environ.get(
+    "EVALUATION_CACHE_PATH", ".evaluation_cache.sqlite"
+)
+
+# Bump when per-row metrics change, so stored scores are not reused
+SCORE_VERSION = 1
+
+
+class ScoreCache(SQLiteCache):
+    """
+    Per-row metrics of each evaluator in a SQLite file, keyed by evaluator
+    and row fingerprints, so re-evaluation only scores new or changed rows.
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS scores (
+            evaluator TEXT NOT NULL,
+            row TEXT NOT NULL,
+            loss REAL NOT NULL,
+            cosine_loss REAL NOT NULL,
+            rank INTEGER NOT NULL,
+            PRIMARY KEY (evaluator, row)
+        )
+    """
+
+    def __init__(self, path=DEFAULT_SCORE_CACHE_PATH):
+        super().__init__(path)
+
+    def get_many(self, evaluator, rows, chunk_size=500):
+        """
+        Return {row: (loss, cosine loss, rank)} of given rows stored for
+        the evaluator fingerprint.
+        """
+        rows = list(dict.fromkeys(rows))
+        scores = {}
+        with self._lock:
+            connection = self._connect()
+            # Stay below SQLite's limit of bound parameters
+            for start in range(0, len(rows), chunk_size):
+                chunk = rows[start : start + chunk_size]
+                placeholders = ", ".join("?" * len(chunk))
+                for row, loss, cosine_loss, rank in connection.execute(
+                    "SELECT row, loss, cosine_loss, rank FROM scores"
+                    f" WHERE evaluator = ? AND row IN ({placeholders})",
+                    [evaluator] + chunk,
+                ):
+                    scores[row] = (loss, cosine_loss, rank)
+        return scores
+
+    def put_many(self, evaluator, scores):
+        """
+        Store (row, loss, cosine loss, rank) tuples of the evaluator fingerprint.
+        """
+        with self._lock:
+            connection = self._connect()
+            connection.executemany(
+                "INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?, ?)",
+                [
+                    (evaluator, row, float(loss), float(cosine_loss), int(rank))
+                    for row, loss, cosine_loss, rank in scores
+                ],
+            )
+            connection.commit()
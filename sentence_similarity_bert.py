@@ -1,29 +1,45 @@
-class BertEmbedding:
-    def __init__(self, model_name):
-        """
-        Load BERT model.
-        """
-        from sentence_transformers import SentenceTransformer
+from embedding_artifact import Embedder
+from embedding_cache import DEFAULT_CACHE_BYTES
+from embedding_store import DEFAULT_STORE_PATH
 
-        self._model = SentenceTransformer(model_name)
-        self._embedding_cache = {}
 
-    def embedding(self, sentence):
+class BertEmbedding(Embedder):
+    def __init__(
+        self,
+        model_name,
+        store_path=DEFAULT_STORE_PATH,
+        cache_max_entries=None,
+        cache_max_bytes=DEFAULT_CACHE_BYTES,
+        cache_codec=None,
+        backend="torch",
+        model=None,
+        **options,
+    ):
         """
-        Return embedding of given sentence.
+        Load BERT model.
+        Embeddings are persisted in the store at `store_path` unless it is None,
+        and recently used ones are kept in memory within the given budget,
+        encoded with `cache_codec` (an `EmbeddingCodec`) if it is given.
+        With backend "onnx", the model runs through ONNX Runtime with
+        `options` of `OnnxSentenceEncoder`. An already loaded `model`, or
+        anything with the same `encode(sentences)` method, is used as is.
         """
-        if sentence not in self._embedding_cache:
-            self._embedding_cache[sentence] = self._model.encode(sentence)
-        return self._embedding_cache[sentence]
+        if model is not None:
+            self._model = model
+        elif backend == "onnx":
+            from onnx_backend import OnnxSentenceEncoder
 
-    def sentence_similarity(self, s1, s2):
-        """
-        Evaluates similarity of two setences.
-        """
-        from sentence_transformers import util
+            self._model = OnnxSentenceEncoder(model_name, **options)
+            # Stored apart from the PyTorch embeddings, which differ slightly
+            model_name = f"{model_name}@{self._model.variant}"
+        else:
+            from sentence_transformers import SentenceTransformer
 
-        s1_embedding = self.embedding(s1)
-        s2_embedding = self.embedding(s2)
+            self._model = SentenceTransformer(model_name)
 
-        return util.pytorch_cos_sim(s1_embedding, s2_embedding)[0][0]
+        super().__init__(
+            model_name, store_path, cache_max_entries, cache_max_bytes, cache_codec
+        )
 
+    def _encode(self, sentences):
+        return self._model.encode(sentences)
@@ -1,32 +1,39 @@
-class OpenAIEmbedding:
-    def __init__(self, model_name):
-        """
-        Load OpenAI model.
-        """
-        from openai import OpenAI
+import numpy as np
 
-        self._client = OpenAI()
-        self.model_name = model_name
-        self._embedding_cache = {}
+from embedding_artifact import Embedder
+from embedding_cache import DEFAULT_CACHE_BYTES
+from embedding_store import DEFAULT_STORE_PATH
 
-    def embedding(self, sentence):
-        """
-        Return embedding of given sentence.
-        """
-        if sentence not in self._embedding_cache:
-            response = self._client.embeddings.create(
-                input=[sentence], model=self.model_name
-            )
-            self._embedding_cache[sentence] = response.data[0].embedding
-        return self._embedding_cache[sentence]
 
-    def sentence_similarity(self, s1, s2):
+class OpenAIEmbedding(Embedder):
+    def __init__(
+        self,
+        model_name,
+        store_path=DEFAULT_STORE_PATH,
+        cache_max_entries=None,
+        cache_max_bytes=DEFAULT_CACHE_BYTES,
+        cache_codec=None,
+        client=None,
+    ):
         """
-        Evaluates similarity of two setences.
+        Load OpenAI model.
+        Embeddings are persisted in the store at `store_path` unless it is None,
+        and recently used ones are kept in memory within the given budget,
+        encoded with `cache_codec` (an `EmbeddingCodec`) if it is given.
+        `client` defaults to the cached, retrying client of `api_client`.
         """
-        s1_embedding = self.embedding(s1)
-        s2_embedding = self.embedding(s2)
+        if client is None:
+            from api_client import create_client
+
+            client = create_client()
+
+        self._client = client
+        super().__init__(
+            model_name, store_path, cache_max_entries, cache_max_bytes, cache_codec
+        )
 
-        return np.dot(s1_embedding, s2_embedding) / (
-            np.linalg.norm(s1_embedding) * np.linalg.norm(s2_embedding)
+    def _encode(self, sentences):
+        response = self._client.embeddings.create(
+            input=list(sentences), model=self.model_name
         )
+        return np.array([item.embedding for item in response.data], dtype=np.float32)
@@ -0,0 +1,303 @@
+"""
+Local HTTP service sharing one warm embedding model between processes.
+
+    python similarity_service.py [--port 8100] [--openai] [--chatbot <chatbot-filename>] [--store <dirname>]
+
+POST /similarity  {"pairs": [["s1", "s2"], ...]}
+              or  {"query": "s", "candidates": ["s1", "s2", ...]}
+              ->  {"similarities": [...]}
+POST /route       {"utterance": "s", "k": 3, "node_id": null}
+              ->  {"routes": [{"node_id": ..., "score": ..., "text": ...}, ...]}
+POST /embeddings  {"texts": ["s1", ...]}  ->  {"embeddings": [[...], ...]}
+GET  /stats       batching and cache counters
+
+Texts cached in memory are answered right away. The rest of concurrent
+requests are coalesced into micro-batches, so the model sees one call per
+batch instead of one per request.
+"""
+import json
+import queue
+import threading
+import time
+import traceback
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+
+class MicroBatcher:
+    """
+    Coalesces texts submitted from many threads into calls of `embed`.
+    Requests join a batch until it holds `max_batch_size` unique texts or
+    `max_wait` seconds have passed since its first request; a request is
+    never split, so its last one may overshoot the size.
+    """
+
+    def __init__(self, embed, max_batch_size=64, max_wait=0.005):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.batches = 0
+        self.texts = 0
+
+        self._embed = embed
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, texts):
+        """
+        Return a future of the embeddings of given texts.
+        """
+        future = Future()
+        self._queue.put((list(texts), future))
+        return future
+
+    def embeddings(self, texts):
+        return self.submit(texts).result()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _collect(self, first):
+        requests = [first]
+        unique = set(first[0])
+        deadline = time.monotonic() + self.max_wait
+        while len(unique) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                # Close after serving what was already submitted
+                self._queue.put(None)
+                break
+            requests.append(request)
+            unique.update(request[0])
+        return requests
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            requests = self._collect(first)
+
+            unique = list(dict.fromkeys(text for texts, _ in requests for text in texts))
+            try:
+                vectors = dict(zip(unique, self._embed(unique)))
+            except Exception as error:
+                for _, future in requests:
+                    future.set_exception(error)
+                continue
+
+            self.batches += 1
+            self.texts += len(unique)
+            for texts, future in requests:
+                future.set_result([vectors[text] for text in texts])
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "texts": self.texts,
+            "mean_batch_size": self.texts / self.batches if self.batches else 0,
+        }
+
+
+class SimilarityService:
+    """
+    Similarity, routing and embeddings of a `BertEmbedding` or
+    `OpenAIEmbedding`, answering cached texts from memory and batching the
+    rest through a `MicroBatcher`.
+    """
+
+    def __init__(self, embedder, routing_index=None, max_batch_size=64, max_wait=0.005):
+        self.embedder = embedder
+        self.routing_index = routing_index
+        self.batcher = MicroBatcher(embedder.embeddings, max_batch_size, max_wait)
+
+    def embeddings(self, texts):
+        vectors = self.embedder.cached_embeddings(texts)
+        missing = [text for text, vector in zip(texts, vectors) if vector is None]
+        if missing:
+            encoded = dict(zip(missing, self.batcher.embeddings(missing)))
+            vectors = [
+                encoded[text] if vector is None else vector
+                for text, vector in zip(texts, vectors)
+            ]
+        return np.asarray(vectors, dtype=np.float32)
+
+    def similarity(self, pairs):
+        if not pairs:
+            return []
+        embeddings = self.embeddings([text for pair in pairs for text in pair])
+        first, second = embeddings[0::2], embeddings[1::2]
+        similarity = np.sum(first * second, axis=1) / (
+            np.linalg.norm(first, axis=1) * np.linalg.norm(second, axis=1)
+        )
+        return np.clip(similarity, -1, 1).tolist()
+
+    def similarity_many(self, query, candidates):
+        return self.similarity([(query, candidate) for candidate in candidates])
+
+    def route(self, utterance, k=3, node_id=None):
+        if self.routing_index is None:
+            raise ValueError("Routing needs the service to be started with a chatbot")
+        query = self.embeddings([utterance])[0]
+        return self.routing_index.route_vector(query, k, node_id)
+
+    def stats(self):
+        return {"batcher": self.batcher.stats(), "cache": self.embedder.cache_stats()}
+
+
+def _text(value, name):
+    if not isinstance(value, str):
+        raise ValueError(f"{name} should be a string")
+    return value
+
+
+def _texts(value, name, item_type=str):
+    """
+    Validate a JSON list of `item_type` items.
+    """
+    if not isinstance(value, list) or not all(
+        isinstance(item, item_type) for item in value
+    ):
+        raise ValueError(f"{name} should be a list of {item_type.__name__}")
+    return value
+
+
+class SimilarityHandler(BaseHTTPRequestHandler):
+    service = None
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self._send_json(200, self.service.stats())
+        elif self.path == "/health":
+            self._send_json(200, {"status": "ok"})
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length))
+            if not isinstance(request, dict):
+                raise ValueError("Request should be a JSON object")
+            response = self._respond(request)
+        except (KeyError, TypeError, ValueError) as error:
+            self._send_json(400, {"error": {"message": str(error)}})
+            return
+        except Exception as error:
+            traceback.print_exc()
+            self._send_json(500, {"error": {"message": str(error)}})
+            return
+        if response is None:
+            self.send_error(404)
+            return
+        self._send_json(200, response)
+
+    def _respond(self, request):
+        if self.path == "/similarity":
+            if "pairs" in request:
+                pairs = _texts(request["pairs"], "pairs", list)
+                for pair in pairs:
+                    if len(_texts(pair, "each pair")) != 2:
+                        raise ValueError("Each pair should hold two texts")
+                similarities = self.service.similarity(pairs)
+            else:
+                similarities = self.service.similarity_many(
+                    _text(request["query"], "query"),
+                    _texts(request["candidates"], "candidates"),
+                )
+            return {"similarities": similarities}
+
+        if self.path == "/route":
+            k = request.get("k", 3)
+            if not isinstance(k, int) or k < 1:
+                raise ValueError("k should be a positive integer")
+            routes = self.service.route(
+                _text(request["utterance"], "utterance"), k, request.get("node_id")
+            )
+            return {
+                "routes": [
+                    {"node_id": node_id, "score": score, "text": text}
+                    for node_id, score, text in routes
+                ]
+            }
+
+        if self.path == "/embeddings":
+            texts = _texts(request["texts"], "texts")
+            return {"embeddings": self.service.embeddings(texts).tolist()}
+
+        return None
+
+    def _send_json(self, status, response):
+        body = json.dumps(response, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class SimilarityServer(ThreadingHTTPServer):
+    # Frontends connect in bursts; the default backlog of 5 resets them
+    request_queue_size = 128
+    daemon_threads = True
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description="Serve sentence similarity")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--model", default="jhgan/ko-sroberta-multitask")
+    parser.add_argument("--openai", action="store_true", help="use OpenAI embeddings")
+    parser.add_argument("--chatbot", default=None, help="chatbot file to route in")
+    parser.add_argument("--artifact", default=None, help="output of precompute.py")
+    parser.add_argument(
+        "--store",
+        default=None,
+        help="persist embeddings in this store directory (off by default, "
+        "since every new utterance would be appended to it)",
+    )
+    parser.add_argument("--max-batch-size", type=int, default=64)
+    parser.add_argument("--max-wait", type=float, default=0.005, help="seconds")
+    args = parser.parse_args()
+
+    if args.openai:
+        from sentence_similarity_openai import OpenAIEmbedding
+
+        embedder = OpenAIEmbedding(args.model, store_path=args.store)
+    else:
+        from sentence_similarity_bert import BertEmbedding
+
+        embedder = BertEmbedding(args.model, store_path=args.store)
+    if args.artifact:
+        embedder.use_artifact(args.artifact)
+
+    routing_index = None
+    if args.chatbot:
+        from routing import RoutingIndex
+
+        sys.path.append("chatbot-dataset")
+
+        from chatbot import parse_from_file
+
+        routing_index = RoutingIndex(parse_from_file(args.chatbot), embedder)
+
+    SimilarityHandler.service = SimilarityService(
+        embedder, routing_index, args.max_batch_size, args.max_wait
+    )
+    server = SimilarityServer(("localhost", args.port), SimilarityHandler)
+    print(f"Serving sentence similarity on http://localhost:{args.port}")
+    server.serve_forever()
@@ -0,0 +1,41 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+
+def fingerprint(value):
+    """
+    Content address of JSON data.
+    """
+    canonical = json.dumps(
+        value, ensure_ascii=False, sort_keys=True, separators=(",", ":")
+    )
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class SQLiteCache:
+    """
+    Base of caches in a SQLite file, connecting on first use.
+    Subclasses give the statement creating their table as `schema`.
+    """
+
+    schema = None
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = None
+        self._pid = None
+
+    def _connect(self):
+        # Connections must not be shared with forked worker processes
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = sqlite3.connect(
+                self.path, check_same_thread=False, timeout=60
+            )
+            self._connection.execute(self.schema)
+            self._connection.commit()
+            self._pid = os.getpid()
+        return self._connection
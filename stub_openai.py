@@ -0,0 +1,147 @@
+"""
+Local stand-in for the OpenAI API, for running label.py, intent.py and the
+evaluators without network access or cost.
+
+    python stub_openai.py [--port 8000] [--latency 0.5] [--error-rate 0.1]
+    OPENAI_API_KEY=stub python label.py ... --base-url http://localhost:8000/v1
+
+Chat completions answer with a `move_to_node` call to a random label, or
+with one of a few canned intents when no tools are given. Embeddings are
+deterministic pseudo-random vectors derived from the input text. With an error rate,
+requests randomly fail with 429 (with Retry-After) or 500 responses.
+"""
+import hashlib
+import json
+import random
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+EMBEDDING_DIM = 1536
+
+STUB_INTENTS = [
+    "채널톡 요금제를 변경하고 싶어요.",
+    "채널톡 요금제를 변경하고 싶어요!",
+    "채용 공고에 지원한 결과를 확인하고 싶어요.",
+    "개발자 포지션의 면접 절차가 궁금해요.",
+    "팀 단위로 도입하려면 견적을 받을 수 있을까요?",
+    "상담 기록을 엑셀로 내보내는 방법을 알고 싶어요.",
+]
+
+
+def stub_embedding(text, dim=EMBEDDING_DIM):
+    seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], "little")
+    rng = random.Random(seed)
+    return [rng.random() for _ in range(dim)]
+
+
+def stub_chat_completion(request):
+    message = {"role": "assistant", "content": None}
+
+    labels = []
+    for tool in request.get("tools", []):
+        if tool["function"]["name"] == "move_to_node":
+            labels = tool["function"]["parameters"]["properties"]["node"]["enum"]
+
+    if labels:
+        message["tool_calls"] = [
+            {
+                "id": f"call_{random.getrandbits(64):x}",
+                "type": "function",
+                "function": {
+                    "name": "move_to_node",
+                    "arguments": json.dumps({"node": random.choice(labels)}),
+                },
+            }
+        ]
+    elif request.get("tools"):
+        message["tool_calls"] = [
+            {
+                "id": f"call_{random.getrandbits(64):x}",
+                "type": "function",
+                "function": {"name": "exit", "arguments": "{}"},
+            }
+        ]
+    else:
+        message["content"] = random.choice(STUB_INTENTS)
+
+    return {
+        "id": f"chatcmpl-{random.getrandbits(64):x}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": request["model"],
+        "choices": [{"index": 0, "message": message, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+    }
+
+
+def stub_embeddings(request):
+    inputs = request["input"]
+    if isinstance(inputs, str):
+        inputs = [inputs]
+
+    return {
+        "object": "list",
+        "model": request["model"],
+        "data": [
+            {"object": "embedding", "index": i, "embedding": stub_embedding(text)}
+            for i, text in enumerate(inputs)
+        ],
+        "usage": {"prompt_tokens": 0, "total_tokens": 0},
+    }
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    latency = 0
+    error_rate = 0
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length))
+
+        if random.random() < self.error_rate:
+            if random.random() < 0.5:
+                self._send_json(429, {"error": {"message": "Rate limit reached"}})
+            else:
+                self._send_json(500, {"error": {"message": "Server error"}})
+            return
+
+        if self.path.endswith("/chat/completions"):
+            response = stub_chat_completion(request)
+        elif self.path.endswith("/embeddings"):
+            response = stub_embeddings(request)
+        else:
+            self.send_error(404)
+            return
+
+        time.sleep(self.latency)
+        self._send_json(200, response)
+
+    def _send_json(self, status, response):
+        body = json.dumps(response, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if status == 429:
+            self.send_header("Retry-After", "0.2")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Local OpenAI API stub")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0, help="seconds")
+    parser.add_argument("--error-rate", type=float, default=0)
+    args = parser.parse_args()
+
+    StubHandler.latency = args.latency
+    StubHandler.error_rate = args.error_rate
+    server = ThreadingHTTPServer(("localhost", args.port), StubHandler)
+    print(f"Serving OpenAI stub on http://localhost:{args.port}/v1")
+    server.serve_forever()